@@ -0,0 +1,180 @@
+import os
+import random
+import argparse
+from collections import deque
+from glob import glob
+from time import perf_counter
+import multiprocessing as mp
+import torch
+from bokeNet import PolicyNet
+import cpu_sched
+import records
+from selfplay import self_play_batched, reinforce_batch, reinforce_loss, gnu_score, local_score, ScoringPool, DEV
+
+def load_policy(path, device = DEV):
+    pi = PolicyNet()
+    pi.load_state_dict(torch.load(path, map_location = device)["model_state_dict"])
+    return pi.to(device)
+
+def actor(color, snapshot, version, opp_id, lock, stop, games_q, bs, scorer = gnu_score, sched = None, rank = 0, score_workers = 0):
+    '''Play batches of `bs` games as `color` with a frozen copy of the learner's policy
+    against the current opponent, pushing an encoded game record and `color` per
+    game to games_q. The learner's side has policy id -1 in the records.
+    New weights and opponents are picked up between batches, and the actor
+    returns after the batch during which stop is set'''
+    if sched is not None:
+        cpu_sched.pin(sched, rank)
+    if score_workers:
+        scorer = ScoringPool(scorer, score_workers)
+    #don't wait on exit to flush games the learner will not read
+    games_q.cancel_join_thread()
+    torch.set_grad_enabled(False)
+    pi = PolicyNet().eval()
+    local_version, local_opp = -1, -1
+    while not stop.is_set():
+        if version.value != local_version:
+            with lock:
+                pi.load_state_dict(snapshot.state_dict())
+                local_version = version.value
+        if opp_id.value != local_opp:
+            local_opp = opp_id.value
+            pi_opp = load_policy(f"v0.3/policy_{local_opp}.pt").eval()
+        if color == "black":
+            ids = (-1, local_opp)
+            games, results = self_play_batched(pi, pi_opp, bs, color, scorer = scorer)
+        else:
+            ids = (local_opp, -1)
+            games, results = self_play_batched(pi_opp, pi, bs, color, scorer = scorer)
+        for mvs, result in zip(games, results):
+            games_q.put((records.encode(records.game_record(mvs, result, *ids)), color))
+    if score_workers:
+        scorer.close()
+
+def fill(buffer, games_q, n, writer = None):
+    '''Move games from games_q into buffer until n new games arrived, appending
+    them to writer if given. Returns the number of games added'''
+    for _ in range(n):
+        buf, color = games_q.get()
+        rec, _ = records.decode(buf)
+        if writer is not None:
+            writer.write(rec)
+        buffer.append((rec, color))
+    return n
+
+def learner_step(pi, optimizer, batch, device = DEV):
+    '''One REINFORCE update on a list of (GameRecord, color) games.
+    Returns the number of training samples and the number of wins'''
+    inputs, pi_mvs, rewards, wins = [], [], [], 0
+    for color in ("black", "white"):
+        games = [rec for rec, c in batch if c == color]
+        fts, mvs, rws, w = reinforce_batch([rec.moves for rec in games], [rec.result for rec in games], color)
+        wins += w
+        if fts is not None:
+            inputs.append(fts)
+            pi_mvs.append(mvs)
+            rewards.append(rws)
+    if not inputs:
+        return 0, wins
+    pi_mvs = torch.cat(pi_mvs).to(device)
+    loss = reinforce_loss(pi, torch.cat(inputs).to(device), pi_mvs, torch.cat(rewards).to(device)) / len(batch)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return len(pi_mvs), wins
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Self-play training with separate actor and learner processes")
+    parser.add_argument("-e", help = "number of epochs", metavar = "E", type = int, dest = 'e', default = 1)
+    parser.add_argument("-b", help = "games per learner batch", metavar = "B", type = int, dest = 'b', default = 64)
+    parser.add_argument("-n", help = "learner steps per epoch", metavar = "N", type = int, dest = 'n', default = 64)
+    parser.add_argument("-a", help = "number of actor processes (default one per core not used by the learner)", metavar = "A", type = int, dest = 'a', default = None)
+    parser.add_argument("--actor-threads", type = int, default = None, help = "torch threads per actor")
+    parser.add_argument("--learner-cores", type = int, default = 1, help = "cores reserved for the learner")
+    parser.add_argument("--actor-bs", type = int, default = 16, help = "games each actor plays in lockstep")
+    parser.add_argument("--buffer", type = int, default = 1024, help = "replay buffer size in games")
+    parser.add_argument("--fresh", type = int, default = 16, help = "new games required between learner steps")
+    parser.add_argument("--publish", type = int, default = 4, help = "learner steps between weight updates for the actors")
+    parser.add_argument("--scorer", type = str, choices = ["gnugo", "local"], default = "gnugo", help = "score finished games with gnugo or go.Game.score")
+    parser.add_argument("--score-workers", type = int, default = 2, help = "threads/processes per actor scoring games in the background (0 scores synchronously)")
+    parser.add_argument("--shards", metavar = "DIR", type = str, default = None, help = "directory to append the actors' game records to")
+    parser.add_argument("-f", help = "file to write stats to", metavar = "PATH", type = str, dest = 'f', default = "v0.3/RL_stats.txt")
+    args = parser.parse_args()
+
+    mp.set_start_method("spawn")
+    sched = cpu_sched.plan(args.a, args.actor_threads, reserve = args.learner_cores)
+    cpu_sched.pin_main(sched)
+    print(f"{max(sched.processes, 2)} actors x {sched.threads} threads on {len(sched.cores)} cores, "
+          f"learner on {len(sched.main_cores)} cores")
+    n_opps = len(glob("v0.3/policy_*.pt")) - 1
+    print(f"Opponent pool size: {n_opps}")
+    checkpt = torch.load(f"v0.3/policy_{n_opps}.pt", map_location = DEV)
+    pi = PolicyNet()
+    pi.load_state_dict(checkpt["model_state_dict"])
+    pi.to(DEV)
+    pi.train()
+    optimizer = torch.optim.AdamW(pi.parameters())
+    if n_opps != 0 and "optimizer_state_dict" in checkpt:
+        optimizer.load_state_dict(checkpt["optimizer_state_dict"])
+
+    #frozen copy of pi that the actors play with
+    snapshot = PolicyNet()
+    snapshot.load_state_dict(pi.state_dict())
+    snapshot.eval()
+    snapshot.share_memory()
+    version = mp.Value('i', 0)
+    opp_id = mp.Value('i', random.randint(0, n_opps))
+    lock = mp.Lock()
+    stop = mp.Event()
+    games_q = mp.Queue()
+    actors = [mp.Process(target = actor, args = ("black" if i%2 == 0 else "white", snapshot, version,
+                                                 opp_id, lock, stop, games_q, args.actor_bs,
+                                                 local_score if args.scorer == "local" else gnu_score, sched, i,
+                                                 args.score_workers))
+              for i in range(max(sched.processes, 2))]
+    for p in actors:
+        p.start()
+
+    buffer = deque(maxlen = args.buffer)
+    writer = None
+    if args.shards:
+        os.makedirs(args.shards, exist_ok = True)
+        writer = records.ShardWriter(os.path.join(args.shards, f"actor_learner_{os.getpid()}.bin"))
+    for epoch in range(args.e):
+        print(f"Epoch: {epoch +1}, playing against Policy {opp_id.value}")
+        winlist = []
+        start = perf_counter()
+        games_in, samples, train_time = 0, 0, 0.0
+        games_in += fill(buffer, games_q, args.b, writer)
+        for step in range(args.n):
+            games_in += fill(buffer, games_q, args.fresh, writer)
+            batch = random.sample(buffer, min(args.b, len(buffer)))
+            t = perf_counter()
+            n, wins = learner_step(pi, optimizer, batch)
+            train_time += perf_counter() - t
+            samples += n
+            winlist.append(wins)
+            if (step + 1) % args.publish == 0:
+                with lock:
+                    snapshot.load_state_dict(pi.state_dict())
+                    version.value += 1
+            if (step + 1) % 10 == 0:
+                elapsed = perf_counter() - start
+                print(f"Step {step + 1}: winrate {sum(winlist[-10:])/(10*len(batch)):.2f}, "
+                      f"{games_in/elapsed:.2f} games/s from actors, {samples/max(train_time, 1e-9):.0f} samples/s training")
+
+        with open(args.f, 'a+') as f:
+            f.write(f"Policy {n_opps} vs. Policy {opp_id.value}\n")
+            f.write(','.join([str(w) for w in winlist]) + '\n')
+        n_opps += 1
+        out_path = os.getcwd() + f"/v0.3/policy_{n_opps}.pt"
+        torch.save({"model_state_dict":pi.state_dict(), "optimizer_state_dict":optimizer.state_dict()}, out_path)
+        #choose a random opponent from the previous policies for the next epoch
+        opp_id.value = random.randint(0, n_opps)
+        buffer.clear()
+
+    if writer is not None:
+        writer.close()
+    #games still in flight are dropped
+    stop.set()
+    for p in actors:
+        p.join()
@@ -0,0 +1,352 @@
+import go
+import argparse
+import multiprocessing as mp
+import numpy as np
+from random import choice, seed
+from time import perf_counter
+import torch
+from bokeNet import PolicyNet, ValueNet, batch_features, policy_dist_batch, value_batch, load_net, load_dataset
+import cpu_sched
+
+def random_positions(n, max_turns = 60):
+    '''Return n go.Game positions reached by random legal play'''
+    positions = []
+    while len(positions) < n:
+        game = go.Game(moves = [])
+        for _ in range(max_turns):
+            legal = [sq_c for sq_c in range(81) if game.is_legal(sq_c)]
+            if not legal:
+                break
+            game.play_move(choice(legal))
+            positions.append(go.Game(board = game.board, ko = game.ko,
+                                     last_move = game.last_move, turn = game.turn))
+    return positions[:n]
+
+def timeit(fn, reps):
+    '''Return mean seconds per call of fn over reps calls (after one warmup call)'''
+    fn()
+    start = perf_counter()
+    for _ in range(reps):
+        fn()
+    return (perf_counter() - start)/reps
+
+def selfplay(args):
+    '''Games/second of sequential vs. lockstep batched self-play'''
+    from selfplay import self_play, self_play_batched, local_score
+    torch.set_grad_enabled(False)
+    pi_1, pi_2 = PolicyNet().eval(), PolicyNet().eval()
+    for name, play in (("sequential", self_play), ("lockstep", self_play_batched)):
+        start = perf_counter()
+        play(pi_1, pi_2, args.games, scorer = local_score)
+        print(f"{name:>10}: {args.games/(perf_counter() - start):.2f} games/s")
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmRSS"))/1024
+
+def data(args):
+    '''Startup time, resident memory and DataLoader samples/second of each dataset file'''
+    from torch.utils.data import DataLoader
+    print(f"{'dataset':>24} {'startup s':>10} {'RSS MB':>8} {'samples/s':>10}")
+    for path in args.paths:
+        rss = rss_mb()
+        start = perf_counter()
+        dataset = load_dataset(path)
+        startup = perf_counter() - start
+        loader = DataLoader(dataset, batch_size = args.bs, shuffle = True, collate_fn = dataset.collate_fn)
+        n = 0
+        start = perf_counter()
+        for batch in loader:
+            n += len(batch[1])
+            if n >= args.samples:
+                break
+        rate = n/(perf_counter() - start)
+        print(f"{path[-24:]:>24} {startup:>10.2f} {rss_mb() - rss:>8.1f} {rate:>10.0f}")
+        del dataset, loader
+
+def sgf_read(args):
+    '''Games/second and MB/second of sgf.read on SGF files, directories or archives'''
+    import os
+    import sgf
+    print(f"{'path':>24} {'games':>8} {'moves':>9} {'games/s':>9} {'MB/s':>7}")
+    for path in args.paths:
+        size = os.path.getsize(path) if not os.path.isdir(path) else \
+            sum(os.path.getsize(os.path.join(d, f)) for d, _, names in os.walk(path) for f in names)
+        games, moves = 0, 0
+        start = perf_counter()
+        for game in sgf.read(path):
+            games += 1
+            moves += len(game.moves)
+        secs = perf_counter() - start
+        print(f"{path[-24:]:>24} {games:>8} {moves:>9} {games/secs:>9.0f} {size/2**20/secs:>7.1f}")
+
+def playout(args):
+    '''Playout length and rollouts/second of MCTS, and game length and games/second
+    of self-play, without and with adjudication of settled positions. Rollouts start
+    from the empty board, or from turn args.turn of each game in args.sgf'''
+    from mcts import MCTS, Go_MCTS
+    from selfplay import self_play_batched, local_score
+    torch.set_grad_enabled(False)
+    pi = load_net(args.p, PolicyNet) if args.p else PolicyNet().eval()
+    starts = [Go_MCTS()]
+    if args.sgf:
+        import sgf
+        starts = []
+        for path in args.sgf:
+            for game in sgf.read(path):
+                if len(game.moves) > args.turn and game.size == go.N and not (game.black or game.white):
+                    node = Go_MCTS(komi = 5.5 if game.komi is None else game.komi)
+                    for mv in game.moves[:args.turn]:
+                        node = node.make_move(mv)
+                    starts.append(node)
+        if not starts:
+            raise SystemExit(f"no 9x9 games longer than {args.turn} moves in {' '.join(args.sgf)}")
+    print(f"{len(starts)} start positions, rollouts scored with {args.scorer}")
+    print(f"{'adjudicate':>10} {'playout turns':>14} {'decided':>8} {'rollouts/s':>11} {'game turns':>11} {'games/s':>8}")
+    for adjudicate in (False, True):
+        start = perf_counter()
+        for i, node in enumerate(starts):
+            tree = MCTS(policy_net = pi, adjudicate = adjudicate, gnu = args.scorer == "gnugo")
+            tree.do_rollout(node, len(range(i, args.rollouts, len(starts))))
+        rollouts = args.rollouts/(perf_counter() - start)
+        #playouts stopped like MCTS._simulate
+        turns, decided = [], 0
+        for i in range(args.rollouts):
+            node = starts[i % len(starts)]
+            while not (node.terminal or (adjudicate and go.adjudicate(node) is not None)):
+                node = node.find_random_child(pi)
+            turns.append(node.turn - starts[i % len(starts)].turn)
+            decided += not node.terminal
+        start = perf_counter()
+        games, _ = self_play_batched(pi, pi, args.games, scorer = local_score, adjudicate = adjudicate)
+        games_s = args.games/(perf_counter() - start)
+        print(f"{str(adjudicate):>10} {sum(turns)/len(turns):>14.1f} {decided/args.rollouts:>8.0%} {rollouts:>11.2f} "
+              f"{sum(map(len, games))/len(games):>11.1f} {games_s:>8.2f}")
+
+def gtp_startup(cmd, moves = ()):
+    '''Seconds from starting the GTP engine cmd to its answer to protocol_version, and to
+    its first genmove after playing moves'''
+    import subprocess
+    start = perf_counter()
+    proc = subprocess.Popen(cmd, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+    def ask(command):
+        proc.stdin.write(command + "\n")
+        proc.stdin.flush()
+        answer = "".join(iter(proc.stdout.readline, "\n")) # answers end with an empty line
+        if not answer.startswith("="):
+            raise RuntimeError(f"{command}: {answer or 'no answer'}")
+        return perf_counter() - start
+    first = ask("protocol_version")
+    for k, move in enumerate(moves):
+        ask(f"play {'W' if k%2 else 'B'} {go.unsquash(move, alph = True)}")
+    times = first, ask(f"genmove {'W' if len(moves)%2 else 'B'}")
+    proc.communicate("quit\n")
+    return times
+
+def startup(args):
+    '''Process start to first GTP response and to first genmove of bokePlay.py --mode gtp,
+    for a training checkpoint (with optimizer state) and its export.py weights file,
+    or for the given network files'''
+    import os
+    import sys
+    import tempfile
+    from statistics import median
+    from bokeNet import save_weights
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.paths
+        if not paths:
+            net = PolicyNet()
+            opt = torch.optim.Adam(net.parameters())
+            net(torch.zeros(2, 27, 9, 9)).sum().backward()
+            opt.step()
+            paths = [os.path.join(tmp, "checkpoint.pt"), os.path.join(tmp, "weights.pt")]
+            torch.save({"model_state_dict": net.state_dict(), "optimizer_state_dict": opt.state_dict()}, paths[0])
+            save_weights(net, paths[1])
+        #bokePlay searches at least 13 rollouts before turn 12; start the search after it
+        game = go.Game(moves = [])
+        while game.turn < 12:
+            game.play_move(choice([sq_c for sq_c in range(81) if game.is_legal(sq_c)]))
+        print(f"{'network':>24} {'MB':>6} {'first response s':>17} {'first genmove s':>16}")
+        for path in paths:
+            cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bokePlay.py"),
+                   "--mode", "gtp", "--scorer", "local", "-r", str(args.rollouts), "-d" if args.dual else "-p", path]
+            times = [gtp_startup(cmd, game.moves) for _ in range(args.reps)]
+            print(f"{os.path.basename(path)[-24:]:>24} {os.path.getsize(path)/2**20:>6.1f} "
+                  f"{median(t[0] for t in times):>17.3f} {median(t[1] for t in times):>16.3f}")
+
+def gtp_client(address, genmoves, latencies, rng):
+    '''Play genmoves moves against random legal moves over one connection to gtp_server.py,
+    appending the seconds of each genmove to latencies. Returns the final boke-stats answer'''
+    import socket
+    sock = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET)
+    sock.connect(address)
+    f = sock.makefile("rw")
+    def ask(command):
+        f.write(command + "\n")
+        f.flush()
+        answer = "".join(iter(f.readline, "\n"))
+        if not answer.startswith("="):
+            raise RuntimeError(f"{command}: {answer or 'no answer'}")
+        return answer[1:].strip()
+    game = None
+    for _ in range(genmoves):
+        if game is None or game.last_move == go.PASS:
+            ask("clear_board")
+            game = go.Game(moves = [])
+        start = perf_counter()
+        move = ask("genmove B")
+        latencies.append(perf_counter() - start)
+        game.play_move(go.PASS if move == "PASS" else go.squash(move, alph = True))
+        legal = [sq_c for sq_c in range(81) if game.is_legal(sq_c) and go.possible_eye(game.board, sq_c) != go.WHITE]
+        move = rng.choice(legal) if legal and game.last_move != go.PASS else go.PASS
+        ask(f"play W {'PASS' if move == go.PASS else go.unsquash(move, alph = True)}")
+        game.play_move(move)
+    stats = ask("boke-stats")
+    ask("quit")
+    sock.close()
+    return stats
+
+def server(args):
+    '''Genmove latency and total nodes/second of gtp_server.py with 1 to args.sessions
+    clients playing at the same time'''
+    import os
+    import sys
+    import subprocess
+    import tempfile
+    import threading
+    from random import Random
+    from bokeNet import save_weights
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.p
+        if path is None:
+            path = os.path.join(tmp, "weights.pt")
+            save_weights(PolicyNet(), path)
+        print(f"{'sessions':>8} {'genmoves':>9} {'p50 ms':>8} {'p99 ms':>8} {'nodes/s':>8} {'mean batch':>11}")
+        for sessions in args.sessions:
+            address = os.path.join(tmp, f"gtp{sessions}.sock")
+            proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gtp_server.py"),
+                                     "-p", path, "--unix", address, "-r", str(args.rollouts), "--workers", str(sessions),
+                                     "--scorer", "local", "--report", "0"],
+                                    stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+            proc.stdout.readline() # serving GTP on ...
+            latencies, stats = [], [None]*sessions
+            def client(i):
+                stats[i] = gtp_client(address, args.genmoves, latencies, Random(args.seed + i))
+            threads = [threading.Thread(target = client, args = (i,)) for i in range(sessions)]
+            start = perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            secs = perf_counter() - start
+            proc.terminate()
+            proc.wait()
+            server_stats = dict(kv.split("=") for kv in stats[-1].split())
+            lat = np.array(latencies)*1000
+            print(f"{sessions:>8} {len(lat):>9} {np.percentile(lat, 50):>8.0f} {np.percentile(lat, 99):>8.0f} "
+                  f"{sessions*args.genmoves*args.rollouts/secs:>8.1f} {server_stats['mean_batch']:>11}")
+
+def sweep_worker(sched, rank, games, barrier, times):
+    cpu_sched.pin(sched, rank)
+    from selfplay import self_play_batched, local_score
+    torch.set_grad_enabled(False)
+    pi_1, pi_2 = PolicyNet().eval(), PolicyNet().eval()
+    self_play_batched(pi_1, pi_2, 2, scorer = local_score) #warmup
+    barrier.wait()
+    #perf_counter is system wide (CLOCK_MONOTONIC), so the spans of the processes compare
+    start = perf_counter()
+    self_play_batched(pi_1, pi_2, games, scorer = local_score)
+    times.put((start, perf_counter()))
+
+def sweep(args):
+    '''Total self-play games/second for every processes x threads split of the cores'''
+    n_cores = len(cpu_sched.available_cores())
+    ctx = mp.get_context("spawn")
+    results = []
+    print(f"{'procs':>6} {'threads':>8} {'games/s':>8}")
+    for threads in [t for t in range(1, n_cores + 1) if n_cores % t == 0]:
+        sched = cpu_sched.plan(threads = threads)
+        barrier, times = ctx.Barrier(sched.processes), ctx.Queue()
+        procs = [ctx.Process(target = sweep_worker, args = (sched, i, args.games, barrier, times))
+                 for i in range(sched.processes)]
+        for p in procs:
+            p.start()
+        spans = [times.get() for _ in procs]
+        for p in procs:
+            p.join()
+        rate = sched.processes*args.games/(max(s[1] for s in spans) - min(s[0] for s in spans))
+        results.append((rate, sched.processes, threads))
+        print(f"{sched.processes:>6} {threads:>8} {rate:>8.2f}")
+    rate, procs, threads = max(results)
+    print(f"Best: {procs} processes x {threads} threads ({rate:.2f} games/s)")
+
+def infer(args):
+    '''Throughput curve of the batched inference API for batch sizes 1 to args.max_bs'''
+    torch.set_grad_enabled(False)
+    pi, v = PolicyNet().eval(), ValueNet().eval()
+    fts = batch_features(random_positions(args.max_bs))
+    print(f"{'batch':>6} {'policy pos/s':>13} {'value pos/s':>12} {'ms/batch':>9}")
+    bs = 1
+    while bs <= args.max_bs:
+        x = fts[:bs]
+        t_pi = timeit(lambda: policy_dist_batch(pi, fts = x), args.reps)
+        t_v = timeit(lambda: value_batch(v, fts = x), args.reps)
+        print(f"{bs:>6} {bs/t_pi:>13.1f} {bs/t_v:>12.1f} {1000*t_pi:>9.2f}")
+        bs *= 2
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks for Boke")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed for generated positions")
+    subparsers = parser.add_subparsers(dest = "bench", required = True)
+
+    p = subparsers.add_parser("infer", help = "network throughput vs. batch size")
+    p.add_argument("--max-bs", type = int, default = 256, help = "largest batch size")
+    p.add_argument("--reps", type = int, default = 20, help = "timed forwards per batch size")
+    p.set_defaults(func = infer)
+
+    p = subparsers.add_parser("selfplay", help = "self-play games/second, sequential vs. lockstep")
+    p.add_argument("--games", type = int, default = 16, help = "games per driver")
+    p.set_defaults(func = selfplay)
+
+    p = subparsers.add_parser("data", help = "startup, memory and samples/second of training datasets")
+    p.add_argument("paths", nargs = "+", help = "csv files, directories of csv shards or .pack files")
+    p.add_argument("--bs", type = int, default = 32, help = "batch size")
+    p.add_argument("--samples", type = int, default = 20000, help = "samples to load from each dataset")
+    p.set_defaults(func = data)
+
+    p = subparsers.add_parser("sgf", help = "games/second parsed by sgf.read")
+    p.add_argument("paths", nargs = "+", help = "SGF files, directories or archives")
+    p.set_defaults(func = sgf_read)
+
+    p = subparsers.add_parser("playout", help = "playout/game length and speed with and without adjudication")
+    p.add_argument("-p", metavar = "PATH", type = str, default = None, help = "policy checkpoint (default random weights)")
+    p.add_argument("--rollouts", type = int, default = 50, help = "MCTS rollouts, shared out between the start positions")
+    p.add_argument("--sgf", metavar = "PATH", nargs = "+", default = None,
+                   help = "start rollouts from the games in these SGF files, directories or archives instead of the empty board")
+    p.add_argument("--turn", type = int, default = 40, help = "move of each --sgf game to start from")
+    p.add_argument("--scorer", type = str, choices = ["gnugo", "local"], default = "local", help = "score finished rollouts with gnugo or go.Game.score")
+    p.add_argument("--games", type = int, default = 16, help = "self-play games, played in lockstep")
+    p.set_defaults(func = playout)
+
+    p = subparsers.add_parser("sweep", help = "self-play games/second for each processes x threads split of the cores")
+    p.add_argument("--games", type = int, default = 16, help = "games per process, played in lockstep")
+    p.set_defaults(func = sweep)
+
+    p = subparsers.add_parser("startup", help = "bokePlay.py GTP startup: time to first response and to first genmove")
+    p.add_argument("paths", nargs = "*", help = "network files (default a random checkpoint and its weights export)")
+    p.add_argument("--dual", action = "store_true", help = "the files are policy-value networks")
+    p.add_argument("--rollouts", type = int, default = 1, help = "rollouts of the genmove")
+    p.add_argument("--reps", type = int, default = 5, help = "engine starts per file (the median is reported)")
+    p.set_defaults(func = startup)
+
+    p = subparsers.add_parser("server", help = "gtp_server.py genmove latency and nodes/second with concurrent clients")
+    p.add_argument("-p", metavar = "PATH", type = str, default = None, help = "policy checkpoint (default random weights)")
+    p.add_argument("--sessions", type = int, nargs = "+", default = [1, 2, 4], help = "numbers of concurrent clients to test")
+    p.add_argument("--genmoves", type = int, default = 4, help = "genmoves per client")
+    p.add_argument("--rollouts", type = int, default = 8, help = "rollouts per genmove")
+    p.set_defaults(func = server)
+
+    args = parser.parse_args()
+    seed(args.seed)
+    torch.manual_seed(args.seed)
+    args.func(args)
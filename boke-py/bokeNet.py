@@ -1,11 +1,14 @@
 import go
 import os
+import pickle
+from glob import glob
 from math import sqrt
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import torch
 from torch.distributions.categorical import Categorical
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, default_collate
 from torch.nn.modules.utils import _pair
 from torch.nn.parameter import Parameter
 import torch.nn as nn
@@ -102,6 +105,56 @@ class ValueNet(nn.Module):
         x = self.relu(self.lin_bn(self.lin1(x)))
         return self.tanh(self.lin2(x))
 
+class PolicyValueNet(nn.Module):
+    '''Policy and value heads sharing one convolutional trunk
+    27 9x9 input features
+    trunk: 1 5x5 convolution, 6 3x3 convolutions: 9x9 -> 9x9
+    policy head: 1 1x1 convolution with untied bias: 9x9 -> 81
+    value head: 1 1x1 convolution with untied bias, 2 fully connected layers
+    output (policy logits over coords 0-81, value between -1 and 1)
+    '''
+    def __init__(self):
+        super(PolicyValueNet, self).__init__()
+        self.conv = nn.Sequential(*conv_trunk())
+        self.policy_conv = Conv2dUntiedBias(9,9,128,1,1)
+        self.value_conv = Conv2dUntiedBias(9,9,128,1,1)
+        self.lin1 = nn.Linear(81,64)
+        self.lin2 = nn.Linear(64,1)
+        self.bn = nn.BatchNorm2d(1)
+        self.lin_bn = nn.BatchNorm1d(64)
+        self.relu = nn.ReLU()
+        self.tanh = nn.Tanh()
+
+    def load_checkpoint_dicts(self, policy_dict, value_dict = None):
+        '''load the trunk and policy head from a PolicyNet state dict and
+        the value head from a ValueNet state dict (the ValueNet trunk is dropped)'''
+        head = "conv.{}.".format(len(self.conv))
+        new_dict = self.state_dict()
+        for k, t in policy_dict.items():
+            new_dict[k.replace(head, "policy_conv.")] = t
+        if value_dict is not None:
+            for k, t in value_dict.items():
+                if k.startswith(head):
+                    new_dict[k.replace(head, "value_conv.")] = t
+                elif not k.startswith("conv."):
+                    new_dict[k] = t
+        self.load_state_dict(new_dict)
+
+    def forward(self, x):
+        x = self.conv(x)
+        p = self.policy_conv(x).view(-1, 81)
+        v = self.relu(self.bn(self.value_conv(x)))
+        v = v.view(-1, 81)
+        v = self.relu(self.lin_bn(self.lin1(v)))
+        return p, self.tanh(self.lin2(v))
+
+def conv_trunk():
+    '''layers of the shared 7 layer 128 channel convolutional trunk'''
+    layers = [nn.Conv2d(27,128,5, padding = 2), nn.BatchNorm2d(128), nn.ReLU()]
+    for _ in range(6):
+        layers += [nn.Conv2d(128,128,3, padding = 1), nn.BatchNorm2d(128), nn.ReLU()]
+    return layers
+
 class Conv2dUntiedBias(nn.Module):
     def __init__(self, height, width, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1):
         super(Conv2dUntiedBias, self).__init__()
@@ -138,23 +191,57 @@ class Conv2dUntiedBias(nn.Module):
     def forward(self, input):
         output = F.conv2d(input, self.weight, None, self.stride,
                         self.padding, self.dilation, self.groups)
-        # add untied bias
-        output += self.bias.unsqueeze(0).repeat(input.size(0), 1, 1, 1)
+        # add untied bias (broadcast over the batch)
+        output += self.bias
         return output
 
+#Gather indices and move maps of the 8 board symmetries, see augment()
+SYM_GATHER = torch.tensor(go.INV_SYMMETRIES)
+SYM_MOVES = torch.tensor(go.SYMMETRIES)
+
+def augment(fts, moves, syms = None):
+    '''Apply a random board symmetry (or symmetries syms) to each position of a batch of
+    (B,27,9,9) features and (B,) moves or (B,81) move distributions.
+    Returns the transformed features and moves'''
+    if syms is None:
+        syms = torch.randint(len(go.SYMMETRIES), (len(moves),))
+    idx = SYM_GATHER[syms]
+    planes_idx = idx.unsqueeze(1).expand(-1, fts.shape[1], -1)
+    fts = fts.reshape(len(moves), fts.shape[1], -1).gather(2, planes_idx).reshape(fts.shape)
+    if moves.dim() == 2:
+        return fts, moves.gather(1, idx)
+    moves = torch.where(moves >= 0, SYM_MOVES[syms, moves.clamp(min = 0)], moves)
+    return fts, moves
+
+def augment_collate(batch):
+    '''collate_fn of an augmenting NinebyNineGames'''
+    fts, moves, *rest = default_collate(batch)
+    return (*augment(fts, moves), *rest)
+
 class NinebyNineGames(Dataset):
-    def __init__(self, path):
-        '''read boards csv from path.'''
-        cols = pd.read_csv(path, nrows = 0).columns
-        self.boards = pd.read_csv(path, converters = {col: self.convert_type for col in cols}, low_memory = False)
+    def __init__(self, path, augment = False):
+        '''read boards csv from path, or every csv shard in directory path
+        (data/pre_process.py). If the csv has a result column (1 if black won,
+        -1 if white won) items also include the result.
+        With augment, a DataLoader using collate_fn = dataset.collate_fn applies
+        a random symmetry to each position of a batch'''
+        paths = sorted(glob(os.path.join(path, "*.csv"))) if os.path.isdir(path) else [path]
+        if not paths:
+            raise ValueError(f"no csv shards in {path}")
+        cols = pd.read_csv(paths[0], nrows = 0).columns
+        self.boards = pd.concat([pd.read_csv(p, converters = {col: self.convert_type for col in cols}, low_memory = False)
+                                 for p in paths], ignore_index = True)
         self.path = path
+        self.with_result = "result" in cols
+        self.collate_fn = augment_collate if augment else None
 
     def __len__(self):
         return len(self.boards)
 
     def __getitem__(self, idx):
-        board, ko, turn, last, move = self.boards.iloc[idx]
-        g = go.Game(board = board, ko = ko, last_move = last, turn = turn)
+        row = self.boards.iloc[idx]
+        board, ko, turn, last, move = row.iloc[:5]
+        g = go.Game(board = board, ko = self.square(ko), last_move = self.square(last), turn = turn)
         
         #For value data
     
@@ -163,8 +250,15 @@ class NinebyNineGames(Dataset):
         #turn = 1 if g.board[last] == go.BLACK else 0
         #g.turn = turn
         #res = -1.0 if val else 1.0
+        if self.with_result:
+            return features(g), move, float(row["result"])
         return features(g), move 
 
+    @staticmethod
+    def square(x):
+        '''ko and last move columns come back as floats, NaN for None'''
+        return None if x is None or x != x else int(x)
+
     @staticmethod
     def convert_type(x):
         if x == "None":
@@ -177,6 +271,117 @@ class NinebyNineGames(Dataset):
             return str(x)
         
 
+#Packed datasets (pack_data.py): a 16 byte header followed by fixed size records of
+#the 27 feature planes as 2187 bits, the move and the result (0 if the csv had none).
+#Every plane is a 0/1 mask times a constant, the layer number for the liberty and capture planes.
+#Deduplicated datasets (pack_data.py --dedup) hold each distinct position once, with the
+#counts of the moves played from it, the number of times it occurred and its mean result
+PACK_MAGIC = b"BOKEPACK"
+PACK_HEADER = 16
+PACK_RECORD = np.dtype([("planes", np.uint8, (274,)), ("move", np.int8), ("result", np.int8)])
+PACK_DEDUP_RECORD = np.dtype([("planes", np.uint8, (274,)), ("counts", np.uint16, (81,)),
+                              ("n", np.uint32), ("result", np.float32)])
+PLANE_SCALE = np.array([1]*6 + list(range(1, 8))*3, dtype = np.float32).reshape(1, 27, 1, 1)
+
+def pack_features(fts):
+    '''(27,9,9) features --> (274,) uint8 bits'''
+    return np.packbits(fts.numpy().reshape(-1) > 0)
+
+def unpack_features(planes):
+    '''(B,274) uint8 bits --> (B,27,9,9) float32 features'''
+    bits = np.unpackbits(planes, axis = 1, count = 27*81).reshape(-1, 27, 9, 9)
+    return torch.from_numpy(bits * PLANE_SCALE)
+
+class PackedGames(Dataset):
+    '''Memory maps a file written by pack_data.py. Items are the same as those of
+    the NinebyNineGames it was packed from, and a DataLoader fetches each batch
+    with one vectorized unpack (pass collate_fn = dataset.collate_fn), returning
+    the batch's items in file order. With augment, every item gets a random symmetry.
+    Items of a deduplicated dataset have the (81,) distribution of the moves played
+    from the position in place of the move, which nn.CrossEntropyLoss takes as a soft target'''
+    def __init__(self, path, augment = False):
+        with open(path, "rb") as f:
+            header = f.read(PACK_HEADER)
+        if header[:8] != PACK_MAGIC:
+            raise ValueError(f"{path} is not a packed dataset")
+        self.with_result = bool(header[8])
+        self.dedup = bool(header[9])
+        self.data = np.memmap(path, dtype = PACK_DEDUP_RECORD if self.dedup else PACK_RECORD,
+                              mode = "r", offset = PACK_HEADER)
+        self.path = path
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return tuple(x[0] for x in self.__getitems__([idx]))
+
+    def __getitems__(self, indices):
+        recs = self.data[np.sort(indices)] # sorted reads are sequential in the file
+        fts = unpack_features(recs["planes"])
+        if self.dedup:
+            counts = recs["counts"].astype(np.float32)
+            moves = torch.from_numpy(counts/counts.sum(axis = 1, keepdims = True))
+        else:
+            moves = torch.from_numpy(recs["move"].astype(np.int64))
+        if self.augment:
+            fts, moves = augment(fts, moves)
+        results = torch.from_numpy(recs["result"].astype(np.float32))
+        return (fts, moves, results) if self.with_result else (fts, moves)
+
+    @staticmethod
+    def collate_fn(batch):
+        return batch # already batched by __getitems__
+
+def load_dataset(path, augment = False):
+    '''PackedGames for a .pack file, NinebyNineGames for a csv or a directory of csv shards'''
+    return (PackedGames if path.endswith(".pack") else NinebyNineGames)(path, augment)
+
+class EvalCache():
+    '''Bounded LRU cache of network evaluations keyed by position.
+    Each entry holds the policy probabilities and the value of a position;
+    either may be missing if only one network has seen it'''
+    POLICY, VALUE = 0, 1
+    def __init__(self, capacity = 65536):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, field):
+        '''Return the cached POLICY or VALUE for key, or None'''
+        entry = self.entries.get(key)
+        if entry is None or entry[field] is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[field]
+
+    def put(self, key, field, val):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [None, None]
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+        else:
+            self.entries.move_to_end(key)
+        entry[field] = val
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                "hit rate": self.hits/lookups if lookups else 0.0, "evictions": self.evictions}
+
 def features(game: go.Game):
     ''' go.Game --> (27,9,9) torch.Tensor
         Compute the input features from the board state
@@ -226,18 +431,22 @@ def features(game: go.Game):
     if isinstance(game.last_move, int) and game.last_move >= 0:
         last_mv[game.last_move] = 1.0
     last_mv = last_mv.reshape(1,9,9)
-    legal = np.array([game.is_legal(sq_c) for sq_c in range(81)], dtype = float) #very slow
     libs = np.array(game.get_liberties(), dtype = float).reshape(9,9)
+    legal = np.zeros(81, dtype = float)
     libs_after = np.zeros(81, dtype = float)
     caps = np.zeros(81, dtype = float)
 
-    for sq_c in np.nonzero(legal)[0]:
+    # one pass over the empty points: a move is legal unless it retakes the ko
+    # or leaves the new stone without liberties after its captures (suicide)
+    for sq_c in range(81):
+        if game.board[sq_c] != go.EMPTY or sq_c == game.ko:
+            continue
         new_board, opp_captured = go.get_caps(go.place_stone(color, game.board,sq_c), sq_c, color)
-        if opp_captured:
-            libs_after[sq_c] = go.get_stone_lib(new_board, sq_c)
+        n_libs = go.get_stone_lib(new_board, sq_c)
+        if n_libs:
+            legal[sq_c] = 1.0
+            libs_after[sq_c] = n_libs
             caps[sq_c] = len(opp_captured)
-        else:
-            libs_after[sq_c] = go.get_stone_lib(go.place_stone(color, game.board, sq_c), sq_c) 
             
     libs_after = libs_after.reshape(9,9)
     caps = caps.reshape(9,9)
@@ -256,6 +465,39 @@ def features(game: go.Game):
     return torch.from_numpy(fts).float()
 
 
+def save_weights(net, path):
+    '''Write the weights of net alone, without optimizer state, for inference. torch.save
+    stores each tensor as its own aligned, uncompressed archive record, so load_net
+    memory maps them in place of reading and copying the file'''
+    weights = OrderedDict((k, v.detach().float().contiguous() if v.is_floating_point() else v.detach().contiguous())
+                          for k, v in net.state_dict().items())
+    torch.save({"net": type(net).__name__, "model_state_dict": weights}, path)
+
+def load_checkpoint(path, device = torch.device("cpu")):
+    '''The dict of a checkpoint, memory mapped unless it is in the legacy (pre zip) format
+    of the v0.2 checkpoints or holds objects other than tensors'''
+    try:
+        return torch.load(path, map_location = "cpu", mmap = True, weights_only = True)
+    except (RuntimeError, pickle.UnpicklingError):
+        return torch.load(path, map_location = device, weights_only = False)
+
+def load_net(path, net_cls = PolicyNet, device = torch.device("cpu")):
+    '''Load a TorchScript module written by export.py, or a training checkpoint or
+    weights file (export.py weights) into a new net_cls. Returns the network in eval mode'''
+    try:
+        net = torch.jit.load(path, map_location = device)
+    except RuntimeError: # not TorchScript
+        checkpt = load_checkpoint(path, device)
+        if checkpt.get("net", net_cls.__name__) != net_cls.__name__:
+            raise ValueError(f"{path} holds the weights of a {checkpt['net']}, not a {net_cls.__name__}")
+        #skip initializing weights that the checkpoint replaces
+        with torch.device("meta"):
+            net = net_cls()
+        net.load_state_dict(checkpt["model_state_dict"], assign = True)
+        net.to(device)
+    net.eval()
+    return net
+
 def policy_dist(policy: PolicyNet,
                 game: go.Game,
                 device = torch.device("cpu"),
@@ -291,3 +533,63 @@ def policy_sample(policy: PolicyNet,
     return m.sample()
 
 
+def batch_features(games):
+    '''list of go.Game --> (B,27,9,9) torch.Tensor'''
+    return torch.stack([features(g) for g in games])
+
+def policy_dist_batch(policy: PolicyNet,
+                      games = None,
+                      device = torch.device("cpu"),
+                      fts: torch.Tensor=None):
+    '''Return (B,81) np.ndarray of move probabilities for a list of games
+    (or a stacked (B,27,9,9) feature tensor) from one forward pass'''
+    if fts is None:
+        fts = batch_features(games)
+    with torch.no_grad():
+        logits = policy(fts.to(device))
+        if isinstance(logits, tuple): # PolicyValueNet
+            logits = logits[0]
+        probs = SOFT(logits)
+    return probs.cpu().numpy()
+
+def value_batch(v: ValueNet,
+                games = None,
+                device = torch.device("cpu"),
+                fts: torch.Tensor=None):
+    '''Return (B,) np.ndarray of value net evaluations for a list of games
+    (or a stacked (B,27,9,9) feature tensor) from one forward pass'''
+    if fts is None:
+        fts = batch_features(games)
+    with torch.no_grad():
+        vals = v(fts.to(device))
+        if isinstance(vals, tuple): # PolicyValueNet
+            vals = vals[1]
+    return vals.view(-1).cpu().numpy()
+
+def policy_value_batch(net: PolicyValueNet,
+                       games = None,
+                       device = torch.device("cpu"),
+                       fts: torch.Tensor=None):
+    '''Return ((B,81), (B,)) np.ndarrays of move probabilities and values
+    from one forward pass of a PolicyValueNet'''
+    if fts is None:
+        fts = batch_features(games)
+    with torch.no_grad():
+        logits, vals = net(fts.to(device))
+        probs = SOFT(logits)
+    return probs.cpu().numpy(), vals.view(-1).cpu().numpy()
+
+def policy_sample_batch(policy: PolicyNet,
+                        games = None,
+                        device = torch.device("cpu"),
+                        fts: torch.Tensor=None):
+    '''sample one move per position. Returns (B,) np.ndarray of coordinates 0-80'''
+    probs = policy_dist_batch(policy, games, device, fts)
+    return sample_probs(probs)
+
+def sample_probs(probs):
+    '''sample a coordinate from each row of a (B,81) or (81,) probability array'''
+    probs = np.atleast_2d(probs)
+    cdf = probs.cumsum(axis = 1)
+    u = np.random.rand(len(probs), 1) * cdf[:, -1:]
+    return np.minimum((cdf < u).sum(axis = 1), probs.shape[1] - 1)
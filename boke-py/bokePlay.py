@@ -3,19 +3,24 @@ import re
 import sys
 import os
 from itertools import cycle
-from bokeNet import PolicyNet, ValueNet, policy_dist
-from mcts import MCTS, Go_MCTS
-from threading import Thread
-import torch
-from torch import load, device, set_grad_enabled 
+from glob import glob
+from threading import Thread, Lock
+from queue import Queue
 import argparse
 from time import sleep
 
 parser = argparse.ArgumentParser(description = "Play against Boke")
-parser.add_argument("-p", metavar="PATH", type = str, dest = 'p', help = "path to policy", default = "v0.2/RL_policy_29.pt")
+parser.add_argument("-p", metavar="PATH", type = str, dest = 'p', help = "path to policy (checkpoint, export.py weights or TorchScript, or a directory: its newest .pt)", default = "v0.2/RL_policy_29.pt")
 parser.add_argument("-v", metavar="PATH", type = str, dest = 'v', help = "path to value net", default = "v0.2/value_2020-11-13_6.pt")
+parser.add_argument("-d", metavar="PATH", type = str, dest = 'd', help = "path to policy-value net or directory (replaces -p and -v)")
 parser.add_argument("-c", type = str, action = 'store', choices = ['W','B'], dest = 'c', help = "Boke's color", default = ['W'])
 parser.add_argument("-r", nargs = 1, metavar="ROLLOUTS", action = 'store', type = int, default = [100], dest = 'r', help = "number of rollouts per move")
+parser.add_argument("--int8", action = "store_true", help = "use the int8 export (<path>_int8.pt from export.py quant) of the network")
+parser.add_argument("--cache", metavar="SIZE", type = int, default = 65536, help = "number of positions in the evaluation cache (0 disables it)")
+parser.add_argument("--threads", type = int, default = None, help = "torch threads for the search (default: all cores, at most cpu_sched.MAX_THREADS)")
+parser.add_argument("--scorer", type = str, choices = ["gnugo", "local"], default = "gnugo", help = "score rollouts with gnugo or go.Game.score")
+parser.add_argument("--watch", metavar = "SECONDS", type = float, default = 0, help = "reload the network when its file changes (or a newer one appears in the -p/-d directory), checking every SECONDS (0: never)")
+parser.add_argument("--ponder", action = "store_true", help = "GTP mode: search while waiting for the next command")
 parser.add_argument("--mode", type = str, choices = ["gui","gtp"], default = "gui", help = "Graphical or GTP mode") 
 args = parser.parse_args()
 
@@ -36,17 +41,172 @@ def loading():
         sys.stdout.flush()
         sleep(0.1)
 
-def gtp(tree, device):
-    '''Go Text Protocol (GTP) interface'''
+def network_file(source, int8 = False):
+    '''The network file of a -p/-d source: the file, or the newest checkpoint in a directory
+    such as v0.3/, or the int8 export of either. Only called once torch is loaded'''
+    from export import int8_path
+    if os.path.isdir(source):
+        files = glob(os.path.join(source, "*.pt"))
+        exports = {int8_path(f) for f in files}
+        checkpoints = [f for f in files if f not in exports]
+        if not checkpoints:
+            raise FileNotFoundError(f"no networks in {source}")
+        source = max(checkpoints, key = os.path.getmtime)
+    return int8_path(source) if int8 else source
+
+def file_stat(path):
+    st = os.stat(path)
+    return path, st.st_mtime_ns, st.st_size
+
+class Engine():
+    '''The network and search tree. torch and the network are only loaded by the first
+    genmove (at start in GUI mode), so a GTP controller gets answers to its setup
+    commands right away; until then the position is kept in a plain go.Game.
+    A new network (reload(), or a new network file with --watch) is loaded in a
+    background thread and put in use by swap() before the next genmove'''
+    def __init__(self, args):
+        self.args = args
+        self.tree = None
+        #checkpoint, weights or TorchScript from export.py weights/fuse/quant, or a directory of them
+        self.source = args.d if args.d else args.p
+        self.path = None # the network file in use
+        self.loaded = None # file_stat of the last network file loaded
+        self.lock = Lock()
+        self.pending = None # (path, network) loaded by reload, not yet in use
+
+    def load(self):
+        if self.tree is not None:
+            return self
+        import torch
+        import cpu_sched
+        from mcts import MCTS, Go_MCTS
+        args = self.args
+        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        cpu_sched.set_threads(args.threads or cpu_sched.plan(processes = 1).threads)
+        if args.int8:
+            torch.backends.quantized.engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+        self.path = network_file(self.source, args.int8)
+        self.loaded = file_stat(self.path)
+        self.net = self.load_net(self.path)
+        self.tree = MCTS(exploration_weight = 0.5, cache_size = args.cache, gnu = args.scorer == "gnugo", **self.nets(self.net))
+        self.node_cls = Go_MCTS
+        torch.set_grad_enabled(False)
+        if args.watch:
+            Thread(target = self.watch, args = (args.watch,), daemon = True).start()
+        return self
+
+    def load_net(self, path):
+        from bokeNet import PolicyNet, PolicyValueNet, load_net
+        return load_net(path, PolicyValueNet if self.args.d else PolicyNet, self.device)
+
+    def nets(self, net):
+        '''MCTS keyword arguments for net'''
+        return {"policy_value_net": net} if self.args.d else {"policy_net": net}
+
+    def reload(self, source = None):
+        '''Load the network of source (a file or directory, default the current source) in the background'''
+        self.source = source or self.source
+        if self.tree is None:
+            return # the first genmove loads it
+        Thread(target = self._reload, daemon = True).start()
+
+    def _reload(self, path = None):
+        try:
+            path = path or network_file(self.source, self.args.int8)
+            self.loaded = file_stat(path)
+            net = self.load_net(path)
+        except Exception as e: # e.g. a checkpoint caught while being written; the next change retries
+            print(f"could not load {path}: {e}", file = sys.stderr)
+            return
+        with self.lock:
+            self.pending = path, net
+
+    def watch(self, interval):
+        '''Reload the network whenever its file changes (or a newer one appears in the
+        source directory), once the file has been unchanged for interval seconds'''
+        last = None
+        while True:
+            sleep(interval)
+            try:
+                current = file_stat(network_file(self.source, self.args.int8))
+            except OSError:
+                current = None
+            if current is not None and current == last and current != self.loaded:
+                self._reload(current[0])
+            last = current
+
+    def swap(self, board):
+        '''Put a network loaded in the background in use, dropping the evaluations of the
+        previous one (including those of board). Returns the path of the new network or None'''
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is None:
+            return None
+        self.path, self.net = pending
+        self.tree.set_nets(**self.nets(self.net))
+        if isinstance(board, self.node_cls):
+            board.dist = board.value = None
+        return self.path
+
+    def board(self, komi = 5.5):
+        '''an empty board: a search node once loaded, a go.Game before'''
+        if self.tree is None:
+            return go.Game(moves = [], komi = komi)
+        return self.node_cls(device = self.device, komi = komi)
+
+    def play(self, board, sq_c):
+        '''board after sq_c: a new search node once loaded, the go.Game board before'''
+        if self.tree is None:
+            board.play_move(sq_c)
+            return board
+        board = board.make_move(sq_c)
+        self.tree.prune(board)
+        return board
+
+    def ponder(self, board, lines):
+        '''Search board until a line arrives on the queue lines, one rollout at a time.
+        Returns the number of rollouts'''
+        if self.tree is None or board.terminal:
+            return 0
+        n = 0
+        while lines.empty():
+            self.tree.do_rollout(board)
+            n += 1
+        return n
+
+    def node(self, board):
+        '''the search node of a board, loading the engine if needed'''
+        self.load()
+        if isinstance(board, self.node_cls):
+            return board
+        node = self.node_cls(board = board.board, ko = board.ko, turn = board.turn, moves = list(board.moves or []),
+                             color = board.turn%2 == 0, last_move = board.last_move, komi = board.komi, device = self.device)
+        node.terminal = node.is_game_over()
+        return node
+
+def read_lines(lines):
+    '''Put the lines of stdin on the queue lines, then None at the end of input'''
+    for line in iter(sys.stdin.readline, ""):
+        lines.put(line)
+    lines.put(None)
+
+def gtp(engine, ponder = False):
+    '''Go Text Protocol (GTP) interface. With ponder, the engine searches the current
+    position while it waits for the next command (once the network has been loaded)'''
     commands = ["name","boardsize", "clear_board", "komi", "play", "genmove", "final_score", "quit",\
-                "version", "showboard", "known_command", "protocol_version", "list_commands"]
-    board = Go_MCTS()
+                "version", "showboard", "known_command", "protocol_version", "list_commands", "boke-reload"]
+    board = engine.board()
     first_pass = False 
+    lines = Queue()
+    Thread(target = read_lines, args = (lines,), daemon = True).start()
+    pondered = 0
     while True:
-        try:
-            line = input().strip()
-        except EOFError:
+        if ponder and not first_pass:
+            pondered += engine.ponder(board, lines)
+        line = lines.get()
+        if line is None:
             break
+        line = line.strip()
         if line == '':
             continue
         cmd = line.split() 
@@ -66,17 +226,17 @@ def gtp(tree, device):
             if len(cmd) == 1:
                 out = "false"
             else:
-                out = "true" if cmd[2] in commands else "false"
+                out = "true" if cmd[1] in commands else "false"
         elif cmd[0] == "boardsize":
             if int(cmd[1]) != 9:
                 print("?"+cmd_id + " Boke only plays on boardsize 9\n\n", end = '')
             else:
                 out = ""
         elif cmd[0] == "clear_board":
-            board = Go_MCTS(device = device)
+            board = engine.board()
             out = ""
         elif cmd[0] == "komi":
-            board = Go_MCTS(komi = float(cmd[1]))
+            board = engine.board(komi = float(cmd[1]))
             out = ""
         #assume alternating play
         elif cmd[0] == "play":
@@ -93,8 +253,11 @@ def gtp(tree, device):
                 else:
                     try:
                         c = go.squash(cmd[2], alph = True)
-                        board = board.make_move(c)
+                        board = engine.play(board, c)
                         out = ""
+                        if pondered:
+                            print(f"pondered {pondered} rollouts, {engine.tree.N.get(board, 0)} on {cmd[2]}", file = sys.stderr)
+                            pondered = 0
                     except:
                         print("?{} Illegal Move\n\n".format(cmd_id), end = '') 
         elif cmd[0] == "showboard":
@@ -102,18 +265,30 @@ def gtp(tree, device):
         elif cmd[0] == "genmove":
             if len(cmd) != 2 or not cmd[1] in ["black", "B", "W", "white"]: 
                 print("?{} Invalid color\n\n".format(cmd_id), end = '')
-            elif first_pass or board.terminal:
-                #always pass if opponent did
-                out = "PASS"
             else:
+                board = engine.node(board)
+                swapped = engine.swap(board)
+                if swapped:
+                    print(f"using {swapped}", file = sys.stderr)
                 turn = 0 if (cmd[1] == "black" or cmd[1] == "B") else 1
-                if turn != board.turn%2:
+                if first_pass or board.terminal:
+                    #always pass if opponent did
+                    out = "PASS"
+                elif turn != board.turn%2:
                     print("?{} It is not {}'s turn\n\n".format(cmd_id, cmd[1]), end='') 
                 else:
                     R = 13 if board.turn < 12 else NUM_ROLLOUTS
-                    tree.do_rollout(board, R) 
-                    board = tree.choose(board)
+                    engine.tree.do_rollout(board, R) 
+                    board = engine.tree.choose(board)
+                    engine.tree.prune(board)
                     out = go.unsquash(board.last_move, alph = True)
+        elif cmd[0] == "boke-reload":
+            #load a network file or the newest in a directory (default: the current source again) for the following genmoves
+            if len(cmd) > 1 and not os.path.exists(cmd[1]):
+                print("?{} No such file\n\n".format(cmd_id), end = '')
+            else:
+                engine.reload(cmd[1] if len(cmd) > 1 else None)
+                out = ""
         elif cmd[0] == "name":
             out = "boke"
         elif cmd[0] == "quit":
@@ -132,25 +307,16 @@ def gtp(tree, device):
         sys.stdout.flush()
     
 if  __name__ == "__main__":
-    device = device("cuda:0" if torch.cuda.is_available() else "cpu")
-    pi = PolicyNet()
-    checkpt = load(args.p, map_location = device)
-    pi.load_state_dict(checkpt["model_state_dict"])
-    pi.to(device)
-    pi.eval()
-    #val = ValueNet()
-    #checkpt = load(args.v, map_location = device)
-    #val.load_state_dict(checkpt["model_state_dict"])
-    #val.to(device)
-    #val.eval()
-    board = Go_MCTS(device = device)
-    tree = MCTS(policy_net=pi, exploration_weight = 0.5)
-    set_grad_enabled(False)
-
+    engine = Engine(args)
     if args.mode == 'gtp':
-        gtp(tree, device)
+        gtp(engine, args.ponder)
         sys.exit()
 
+    from bokeNet import policy_dist_batch
+    engine.load()
+    tree, pi, device = engine.tree, engine.net, engine.device
+    board = engine.board()
+
     if args.c[0] == 'B': 
         print(board)
         tree.do_rollout(board, NUM_ROLLOUTS)
@@ -171,7 +337,7 @@ if  __name__ == "__main__":
         
         uin = in_ref[0]
         if uin == 'h':
-            move = torch.argmax(policy_dist(pi, board, device = device).probs).item()
+            move = int(policy_dist_batch(pi, [board], device = device)[0].argmax())
             print("Boke's hint: " + go.unsquash(move, alph = True)) 
             sleep(3)
         elif uin == 'q':
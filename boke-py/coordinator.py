@@ -0,0 +1,293 @@
+'''Multi-host self-play. Actors connect to the coordinator over TCP, pull the
+policy weights and opponent they are assigned, and push back finished games as
+records.encode()d bytes. Every message is a 5 byte header (type, payload length)
+followed by the payload:
+    HELLO        actor -> coordinator  actor name (utf-8)
+    ASSIGN       coordinator -> actor  policy id, opponent id, color (0 black, 1 white)
+    GET_WEIGHTS  actor -> coordinator  policy id
+    WEIGHTS      coordinator -> actor  torch.save()d state dict
+    GAME         actor -> coordinator  one game record, answered with ASSIGN
+    NO_POLICY    coordinator -> actor  instead of ASSIGN while the pool is empty; the
+                                       coordinator then closes the connection
+Malformed messages are logged and the connection is dropped'''
+import io
+import os
+import re
+import random
+import socket
+import socketserver
+import struct
+import argparse
+import threading
+from glob import glob
+from time import perf_counter, sleep
+import torch
+from bokeNet import PolicyNet
+import records
+import cpu_sched
+from selfplay import self_play_batched, gnu_score, local_score, ScoringPool
+
+HELLO, ASSIGN, GET_WEIGHTS, WEIGHTS, GAME, NO_POLICY = range(6)
+HEADER = struct.Struct("<BI")
+ASSIGNMENT = struct.Struct("<iiB")
+POLICY_ID = struct.Struct("<i")
+COLORS = ("black", "white")
+
+def send_msg(sock, kind, payload = b""):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buf += chunk
+    return bytes(buf)
+
+def recv_msg(sock):
+    '''Return the (type, payload) of the next message. Raises ConnectionError
+    if the peer disconnects, so a partial message is never returned'''
+    kind, n = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return kind, recv_exact(sock, n)
+
+class Coordinator():
+    '''Hands out assignments and weights from the policy pool in pool_dir and
+    writes the games actors send to append-only shards of shard_games games in out_dir'''
+    def __init__(self, pool_dir = "v0.3", out_dir = "shards", shard_games = 1024):
+        self.pool_dir = pool_dir
+        self.out_dir = out_dir
+        self.shard_games = shard_games
+        os.makedirs(out_dir, exist_ok = True)
+        self.lock = threading.Lock()
+        self.weights_cache = {}
+        self.actors = {} # name -> [first seen, games, connected]
+        self.unscored = 0 # games dropped for lack of a result
+        self.n_shards = len(glob(os.path.join(out_dir, "games_*.bin")))
+        self.writer = self._new_shard()
+        self.start = perf_counter()
+
+    def _new_shard(self):
+        self.n_shards += 1
+        return records.ShardWriter(os.path.join(self.out_dir, f"games_{self.n_shards}.bin"))
+
+    def policy_ids(self):
+        '''ids of the policy_N.pt files in the pool, which learners keep adding to'''
+        names = (os.path.basename(p) for p in glob(os.path.join(self.pool_dir, "policy_*.pt")))
+        return sorted(int(m.group(1)) for m in map(re.compile(r"policy_(\d+)\.pt$").match, names) if m)
+
+    def newest(self):
+        '''id of the newest policy in the pool, -1 if it is empty'''
+        ids = self.policy_ids()
+        return ids[-1] if ids else -1
+
+    def assignment(self):
+        '''the newest policy against a random one of the pool, None if the pool is empty'''
+        ids = self.policy_ids()
+        if not ids:
+            return None
+        return ASSIGNMENT.pack(ids[-1], random.choice(ids), random.randint(0, 1))
+
+    def weights(self, policy_id):
+        with self.lock:
+            if policy_id in self.weights_cache:
+                return self.weights_cache[policy_id]
+        #load outside the lock, so other actors are not held up meanwhile
+        path = os.path.join(self.pool_dir, f"policy_{policy_id}.pt")
+        if not os.path.exists(path):
+            raise ValueError(f"no policy {policy_id} in {self.pool_dir}")
+        checkpt = torch.load(path, map_location = "cpu")
+        buf = io.BytesIO()
+        torch.save(checkpt["model_state_dict"], buf) # actors don't need the optimizer state
+        with self.lock:
+            return self.weights_cache.setdefault(policy_id, buf.getvalue())
+
+    def connect(self, name):
+        with self.lock:
+            if name not in self.actors:
+                self.actors[name] = [perf_counter(), 0, True]
+            self.actors[name][2] = True
+
+    def disconnect(self, name):
+        with self.lock:
+            if name in self.actors:
+                self.actors[name][2] = False
+
+    def add_game(self, name, payload):
+        rec = records.decode_message(payload)
+        with self.lock:
+            if rec.result == -1:
+                #the actor could not score it; nothing downstream can train on it
+                self.unscored += 1
+                return
+            self.writer.write(rec)
+            if self.writer.count >= self.shard_games:
+                self.writer.close()
+                self.writer = self._new_shard()
+            self.actors[name][1] += 1
+
+    def report(self):
+        now = perf_counter()
+        with self.lock:
+            lines = [f"{name:>24}: {games:>6} games, {60*games/max(now - first, 1e-9):>7.1f} games/min"
+                     + ("" if connected else " (disconnected)")
+                     for name, (first, games, connected) in sorted(self.actors.items())]
+            total = sum(a[1] for a in self.actors.values())
+        print(f"{total} games in {(now - self.start)/60:.1f} min, "
+              f"{60*total/max(now - self.start, 1e-9):.1f} games/min, {self.unscored} unscored dropped, shard {self.writer.path}")
+        print('\n'.join(lines))
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+
+class ActorHandler(socketserver.BaseRequestHandler):
+    def assign(self, coord):
+        '''Send an assignment. Returns False if there is none yet'''
+        assignment = coord.assignment()
+        if assignment is None:
+            send_msg(self.request, NO_POLICY)
+            return False
+        send_msg(self.request, ASSIGN, assignment)
+        return True
+
+    def handle(self):
+        coord = self.server.coordinator
+        name = None
+        try:
+            while True:
+                kind, payload = recv_msg(self.request)
+                if kind == HELLO:
+                    name = payload.decode("utf-8", errors = "replace")
+                    coord.connect(name)
+                    print(f"{name} connected from {self.client_address[0]}")
+                    if not self.assign(coord):
+                        print(f"{name}: no policy in {coord.pool_dir} yet")
+                        break
+                elif kind == GET_WEIGHTS:
+                    if len(payload) != POLICY_ID.size:
+                        raise ValueError(f"policy id of {len(payload)} bytes")
+                    send_msg(self.request, WEIGHTS, coord.weights(POLICY_ID.unpack(payload)[0]))
+                elif kind == GAME and name is not None:
+                    coord.add_game(name, payload)
+                    if not self.assign(coord):
+                        break
+                else:
+                    raise ValueError(f"unexpected message type {kind}")
+        except (ConnectionError, OSError) as e:
+            # games the actor was still playing are lost, finished ones are already written
+            print(f"{name or self.client_address[0]} disconnected: {e}")
+        except ValueError as e:
+            print(f"{name or self.client_address[0]}: dropping connection after a malformed message: {e}")
+        finally:
+            if name is not None:
+                coord.disconnect(name)
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, coordinator):
+        super().__init__(address, ActorHandler)
+        self.coordinator = coordinator
+
+def serve(args):
+    coord = Coordinator(args.pool, args.out, args.shard_games)
+    server = CoordinatorServer((args.host, args.port), coord)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    print(f"Coordinator listening on {args.host}:{args.port}, pool {args.pool} (newest policy {coord.newest()})")
+    try:
+        while True:
+            sleep(args.report)
+            coord.report()
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    coord.close()
+
+class Actor():
+    '''Client side of the protocol. Keeps the policies of the current assignment'''
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.nets = {}
+        send_msg(sock, HELLO, name.encode("utf-8"))
+        self.assignment = self._recv_assignment()
+
+    def _recv_assignment(self):
+        kind, payload = recv_msg(self.sock)
+        if kind == NO_POLICY:
+            raise ConnectionError("the coordinator has no policy yet")
+        if kind != ASSIGN:
+            raise ConnectionError(f"expected an assignment, got message type {kind}")
+        return ASSIGNMENT.unpack(payload)
+
+    def policy(self, policy_id):
+        if policy_id not in self.nets:
+            send_msg(self.sock, GET_WEIGHTS, POLICY_ID.pack(policy_id))
+            kind, payload = recv_msg(self.sock)
+            if kind != WEIGHTS:
+                raise ConnectionError(f"expected weights, got message type {kind}")
+            pi = PolicyNet()
+            pi.load_state_dict(torch.load(io.BytesIO(payload)))
+            self.nets[policy_id] = pi.eval()
+        return self.nets[policy_id]
+
+    def play(self, bs, scorer = gnu_score):
+        '''Play bs games of the current assignment and push them. Returns the number of games'''
+        policy_id, opp_id, color = self.assignment
+        pi, pi_opp = self.policy(policy_id), self.policy(opp_id)
+        #drop the weights of earlier assignments
+        self.nets = {i: self.nets[i] for i in (policy_id, opp_id)}
+        black, white = (policy_id, opp_id) if color == 0 else (opp_id, policy_id)
+        games, results = self_play_batched(self.nets[black], self.nets[white], bs, scorer = scorer)
+        for mvs, result in zip(games, results):
+            send_msg(self.sock, GAME, records.encode(records.game_record(mvs, result, black, white)))
+            self.assignment = self._recv_assignment()
+        return len(games)
+
+def actor(args):
+    torch.set_grad_enabled(False)
+    cpu_sched.set_threads(args.threads or cpu_sched.plan(processes = 1).threads)
+    name = args.name or f"{socket.gethostname()}:{os.getpid()}"
+    scorer = local_score if args.scorer == "local" else gnu_score
+    if args.score_workers:
+        scorer = ScoringPool(scorer, args.score_workers)
+    while True:
+        try:
+            with socket.create_connection((args.host, args.port)) as sock:
+                a = Actor(sock, name)
+                print(f"Connected to {args.host}:{args.port} as {name}")
+                while True:
+                    start = perf_counter()
+                    policy_id, opp_id, color = a.assignment
+                    n = a.play(args.b, scorer)
+                    print(f"{n} games of Policy {policy_id} as {COLORS[color]} vs. Policy {opp_id}, "
+                          f"{60*n/(perf_counter() - start):.1f} games/min")
+        except (ConnectionError, OSError) as e:
+            print(f"Lost coordinator ({e}), retrying in {args.retry}s")
+            sleep(args.retry)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Self-play across hosts with a TCP coordinator")
+    parser.add_argument("--host", type = str, default = "localhost", help = "coordinator address")
+    parser.add_argument("--port", type = int, default = 5555, help = "coordinator port")
+    subparsers = parser.add_subparsers(dest = "role", required = True)
+
+    p = subparsers.add_parser("serve", help = "run the coordinator")
+    p.add_argument("--pool", type = str, default = "v0.3", help = "directory of policy_N.pt checkpoints")
+    p.add_argument("--out", type = str, default = "shards", help = "directory to write game shards to")
+    p.add_argument("--shard-games", type = int, default = 1024, help = "games per shard file")
+    p.add_argument("--report", type = float, default = 60, help = "seconds between actor reports")
+    p.set_defaults(func = serve)
+
+    p = subparsers.add_parser("actor", help = "play games for a coordinator")
+    p.add_argument("-b", help = "games to play in lockstep per assignment", metavar = "B", type = int, dest = 'b', default = 16)
+    p.add_argument("--name", type = str, default = None, help = "actor name in reports (default host:pid)")
+    p.add_argument("--scorer", type = str, choices = ["gnugo", "local"], default = "gnugo", help = "score finished games with gnugo or go.Game.score")
+    p.add_argument("--score-workers", type = int, default = 2, help = "threads/processes scoring games in the background (0 scores synchronously)")
+    p.add_argument("--threads", type = int, default = None, help = "torch threads (default: all cores, at most cpu_sched.MAX_THREADS)")
+    p.add_argument("--retry", type = float, default = 5, help = "seconds between reconnection attempts")
+    p.set_defaults(func = actor)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,73 @@
+'''Splits the cores this process may run on between worker processes and torch
+threads, so that processes * threads does not oversubscribe the machine, and pins
+each worker to its own cores. Usage:
+    sched = plan(processes, threads, reserve)    # in the parent
+    pin(sched, rank)                             # first thing in worker `rank`
+    pin_main(sched)                              # in the parent, if it does work itself'''
+import os
+from collections import namedtuple
+from functools import partial
+import torch
+
+#self-play and search evaluate batches of 9x9 positions, too small for more
+#intra-op threads than this to pay off (see bench.py sweep)
+MAX_THREADS = 4
+
+Plan = namedtuple("Plan", ["processes", "threads", "cores", "main_cores"])
+
+def available_cores():
+    '''Cores this process may run on, respecting taskset and cgroup affinity'''
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def plan(processes = None, threads = None, reserve = 0):
+    '''Return a Plan splitting the available cores. The first `reserve` cores are kept
+    for the parent process (a learner, an evaluator, the training loop) and the rest
+    go to the workers. Given neither processes nor threads, there is one single-threaded
+    worker per core; given one of them, the other fills the workers' cores'''
+    cores = available_cores()
+    reserve = max(min(reserve, len(cores) - 1), 0)
+    main_cores, cores = cores[:reserve] or cores, cores[reserve:]
+    if processes is None:
+        threads = threads or 1
+        processes = max(len(cores)//threads, 1)
+    elif threads is None:
+        threads = min(max(len(cores)//processes, 1), MAX_THREADS)
+    if processes * threads > len(cores):
+        print(f"Warning: {processes} processes x {threads} threads oversubscribe {len(cores)} cores")
+    return Plan(processes, threads, cores, main_cores)
+
+def worker_cores(sched, rank):
+    '''Cores of worker `rank`: consecutive blocks of sched.threads cores, wrapping
+    around when the plan is oversubscribed'''
+    start = rank * sched.threads
+    return sorted({sched.cores[(start + i) % len(sched.cores)] for i in range(sched.threads)})
+
+def set_threads(threads, interop = 1):
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop)
+    except RuntimeError: # can only be set before the first inter-op parallel work
+        pass
+
+def set_affinity(cores):
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError: # e.g. cores outside of a container's cpuset
+            pass
+
+def pin(sched, rank):
+    '''Pin worker `rank` to its cores and size its torch thread pools'''
+    set_affinity(worker_cores(sched, rank))
+    set_threads(sched.threads)
+
+def pin_main(sched, threads = None):
+    '''Pin the parent to its reserved cores, with one torch thread per core by default'''
+    set_affinity(sched.main_cores)
+    set_threads(threads or len(sched.main_cores))
+
+def worker_init(sched):
+    '''worker_init_fn for a torch DataLoader with sched.processes workers'''
+    return partial(pin, sched)
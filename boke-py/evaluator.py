@@ -0,0 +1,225 @@
+import io
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from time import perf_counter
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import cpu_sched
+
+class EvaluatorError(RuntimeError):
+    '''A batch failed in the evaluator. Raised to every client of the batch in place of
+    the network output; the evaluator keeps serving later batches'''
+
+class EvalStats():
+    '''Batch size histogram and request latencies of an evaluator'''
+    def __init__(self, window = 10000):
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen = window)
+        self.requests = 0
+
+    def record(self, batch_size, latencies):
+        self.batch_sizes[batch_size] += 1
+        self.latencies.extend(latencies)
+        self.requests += len(latencies)
+
+    def summary(self, queue_depth):
+        lat = np.array(self.latencies) * 1000
+        return {"queue depth": queue_depth,
+                "requests": self.requests,
+                "batches": sum(self.batch_sizes.values()),
+                "batch sizes": dict(sorted(self.batch_sizes.items())),
+                "p50 ms": float(np.percentile(lat, 50)) if len(lat) else None,
+                "p99 ms": float(np.percentile(lat, 99)) if len(lat) else None}
+
+def get_request(requests, timeout, control):
+    '''Return the next request. Control requests (features None) are passed to control'''
+    while True:
+        req = requests.get(timeout = timeout)
+        if req is None or req[2] is not None or control is None:
+            return req
+        control(req)
+
+def collect(requests, max_batch, max_wait, control = None):
+    '''Block for one request, then gather more until the batch holds max_batch
+    positions or max_wait seconds have passed. Returns None on shutdown'''
+    first = get_request(requests, None, control)
+    if first is None:
+        return None
+    batch = [first]
+    size = len(first[2])
+    deadline = perf_counter() + max_wait
+    while size < max_batch:
+        timeout = deadline - perf_counter()
+        if timeout <= 0:
+            break
+        try:
+            req = get_request(requests, timeout, control)
+        except queue.Empty:
+            break
+        if req is None:
+            requests.put(None) # finish this batch, stop on the next collect
+            break
+        batch.append(req)
+        size += len(req[2])
+    return batch
+
+def serve(net, requests, respond, stats, max_batch, max_wait, device, control = None):
+    '''Evaluate batches of (client, request id, features, submit time) requests until
+    a None request arrives. respond(client, request id, output) returns each result,
+    or an EvaluatorError if the batch failed'''
+    with torch.no_grad():
+        while True:
+            batch = collect(requests, max_batch, max_wait, control)
+            if batch is None:
+                break
+            sizes = [len(req[2]) for req in batch]
+            try:
+                out = net(torch.cat([req[2] for req in batch]).to(device))
+                if isinstance(out, tuple):
+                    parts = list(zip(*[o.cpu().split(sizes) for o in out]))
+                else:
+                    parts = out.cpu().split(sizes)
+            except Exception as e:
+                #a plain message pickles across processes, whatever the original exception holds
+                error = EvaluatorError(f"{type(e).__name__}: {e}")
+                for req in batch:
+                    respond(req[0], req[1], error)
+                continue
+            now = perf_counter()
+            for req, part in zip(batch, parts):
+                respond(req[0], req[1], part)
+            stats.record(sum(sizes), [now - req[3] for req in batch])
+
+class BatchEvaluator():
+    '''Owns a network and evaluates features submitted by many searchers in one
+    background thread, batching requests up to max_batch positions or max_wait seconds.
+    Calling it like the network returns that network's output, so it drops in for a
+    PolicyNet, ValueNet or PolicyValueNet in MCTS and selfplay'''
+    def __init__(self, net, max_batch = 64, max_wait = 0.002, device = torch.device("cpu")):
+        self.requests = queue.Queue()
+        self._stats = EvalStats()
+        self.thread = threading.Thread(target = serve, daemon = True,
+                                       args = (net, self.requests, self._respond, self._stats,
+                                               max_batch, max_wait, device))
+        self.thread.start()
+
+    @staticmethod
+    def _respond(future, _, out):
+        if isinstance(out, EvaluatorError):
+            future.set_exception(out)
+        else:
+            future.set_result(out)
+
+    def submit(self, fts):
+        '''submit a (B,27,9,9) feature tensor. Returns a Future of the network output'''
+        future = Future()
+        self.requests.put((future, None, fts.cpu(), perf_counter()))
+        return future
+
+    def __call__(self, fts):
+        return self.submit(fts).result()
+
+    def stats(self):
+        return self._stats.summary(self.requests.qsize())
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+def serve_process(net, requests, responses, max_batch, max_wait, device, cores = None):
+    '''Target of the EvaluatorProcess. A request with features None asks for the stats'''
+    if cores:
+        cpu_sched.set_affinity(cores)
+        cpu_sched.set_threads(len(cores))
+    if isinstance(net, bytes): # TorchScript
+        net = torch.jit.load(io.BytesIO(net), map_location = device)
+    net.to(device).eval()
+    stats = EvalStats()
+    def respond(client, req_id, out):
+        responses[client].put((req_id, out))
+    def control(req):
+        respond(req[0], req[1], stats.summary(requests.qsize()))
+    serve(net, requests, respond, stats, max_batch, max_wait, device, control)
+
+class EvaluatorClient():
+    '''Handle to an EvaluatorProcess for one worker process. Behaves like the network'''
+    def __init__(self, client_id, requests, responses):
+        self.client_id = client_id
+        self.requests = requests
+        self.responses = responses # this client's response queue
+        self._init_local()
+
+    def _init_local(self):
+        self.pending = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.receiver = None
+
+    def __getstate__(self):
+        return (self.client_id, self.requests, self.responses)
+
+    def __setstate__(self, state):
+        self.client_id, self.requests, self.responses = state
+        self._init_local()
+
+    def _receive(self):
+        while True:
+            req_id, out = self.responses.get()
+            with self.lock:
+                future = self.pending.pop(req_id)
+            if isinstance(out, EvaluatorError):
+                future.set_exception(out)
+            else:
+                future.set_result(out)
+
+    def _submit(self, fts):
+        future = Future()
+        with self.lock:
+            if self.receiver is None:
+                self.receiver = threading.Thread(target = self._receive, daemon = True)
+                self.receiver.start()
+            req_id = self.next_id
+            self.next_id += 1
+            self.pending[req_id] = future
+        self.requests.put((self.client_id, req_id, fts, perf_counter()))
+        return future
+
+    def submit(self, fts):
+        '''submit a (B,27,9,9) feature tensor. Returns a Future of the network output'''
+        return self._submit(fts.cpu().share_memory_())
+
+    def __call__(self, fts):
+        return self.submit(fts).result()
+
+    def stats(self):
+        return self._submit(None).result()
+
+class EvaluatorProcess():
+    '''Runs the batching evaluator in its own process, which owns the network.
+    Worker processes get an EvaluatorClient from client(i) and submit feature
+    tensors through a shared memory queue; create the clients before starting the workers.
+    If cores is given the process is pinned to them with one torch thread per core'''
+    def __init__(self, net, n_clients, max_batch = 64, max_wait = 0.002, device = torch.device("cpu"), cores = None):
+        if isinstance(net, torch.jit.ScriptModule):
+            buf = io.BytesIO()
+            torch.jit.save(net, buf)
+            net = buf.getvalue()
+        self.requests = mp.Queue()
+        self.responses = [mp.Queue() for _ in range(n_clients + 1)]
+        self.process = mp.Process(target = serve_process, daemon = True,
+                                  args = (net, self.requests, self.responses, max_batch, max_wait, device, cores))
+        self.process.start()
+        self.own_client = self.client(n_clients)
+
+    def client(self, i):
+        return EvaluatorClient(i, self.requests, self.responses[i])
+
+    def stats(self):
+        return self.own_client.stats()
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join()
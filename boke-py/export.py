@@ -0,0 +1,199 @@
+import os
+import argparse
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.quantization import QuantStub, DeQuantStub
+from bench import random_positions, timeit
+from bokeNet import PolicyNet, ValueNet, PolicyValueNet, Conv2dUntiedBias, NinebyNineGames, batch_features, load_net, save_weights
+
+NETS = {"policy": PolicyNet, "value": ValueNet, "dual": PolicyValueNet}
+
+def convert_dual(policy_path, value_path = None, device = torch.device("cpu")):
+    '''Build a PolicyValueNet from PolicyNet and (optionally) ValueNet training checkpoints.
+    The trunk and policy head come from the policy, the value head from the value net'''
+    net = PolicyValueNet()
+    policy_dict = torch.load(policy_path, map_location = device)["model_state_dict"]
+    value_dict = None
+    if value_path:
+        value_dict = torch.load(value_path, map_location = device)["model_state_dict"]
+    net.load_checkpoint_dicts(policy_dict, value_dict)
+    return net
+
+def fold_bn(layer, bn):
+    '''Fold the eval mode BatchNorm bn into the preceding Conv2d, Conv2dUntiedBias
+    or Linear layer (in place)'''
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        w_shape = (-1,) + (1,) * (layer.weight.dim() - 1)
+        layer.weight.mul_(scale.view(w_shape))
+        if isinstance(layer, Conv2dUntiedBias):
+            layer.bias.mul_(scale.view(-1, 1, 1)).add_(shift.view(-1, 1, 1))
+        else:
+            layer.bias.mul_(scale).add_(shift)
+
+def fold_batchnorm(net):
+    '''Return an eval mode copy of a PolicyNet, ValueNet or PolicyValueNet with every
+    BatchNorm folded into the layer before it and replaced by nn.Identity'''
+    net = copy.deepcopy(net).eval()
+    for i, m in enumerate(net.conv):
+        if isinstance(m, nn.BatchNorm2d):
+            fold_bn(net.conv[i-1], m)
+            net.conv[i] = nn.Identity()
+    if hasattr(net, "lin_bn"): # value head
+        fold_bn(net.value_conv if hasattr(net, "value_conv") else net.conv[-1], net.bn)
+        fold_bn(net.lin1, net.lin_bn)
+        net.bn, net.lin_bn = nn.Identity(), nn.Identity()
+    return net
+
+def freeze(net):
+    '''Trace and freeze an eval mode network as TorchScript'''
+    with torch.no_grad():
+        traced = torch.jit.trace(net, torch.zeros(1, 27, 9, 9))
+    return torch.jit.freeze(traced)
+
+def compare(net, exported, n = 256, reps = 100):
+    '''Return the largest output difference between net and exported on n positions
+    and their single position latencies (seconds)'''
+    fts = batch_features(random_positions(n))
+    with torch.no_grad():
+        out, out_exp = net(fts), exported(fts)
+        if not isinstance(out, tuple):
+            out, out_exp = (out,), (out_exp,)
+        err = max((a - b).abs().max().item() for a, b in zip(out, out_exp))
+        x = fts[:1]
+        t_net = timeit(lambda: net(x), reps)
+        t_exp = timeit(lambda: exported(x), reps)
+    return err, t_net, t_exp
+
+def quantize(net, calib_fts, backend = "fbgemm", bs = 64):
+    '''Post-training static int8 quantization. The convolutional trunk (with BatchNorm
+    and ReLU fused into each convolution) runs in int8; the untied bias heads and the
+    value head's fully connected layers stay fp32. Activation ranges are calibrated
+    on the (N,27,9,9) tensor calib_fts'''
+    torch.backends.quantized.engine = backend
+    net = copy.deepcopy(net).eval()
+    layers = list(net.conv)
+    n_trunk = len(leading_conv_blocks(layers))
+    trunk = nn.Sequential(*layers[:n_trunk])
+    torch.quantization.fuse_modules(trunk, [[str(i), str(i+1), str(i+2)] for i in range(0, n_trunk, 3)], inplace = True)
+    trunk = nn.Sequential(QuantStub(), *trunk, DeQuantStub())
+    trunk.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(trunk, inplace = True)
+    net.conv = nn.Sequential(trunk, *layers[n_trunk:])
+    with torch.no_grad():
+        for i in range(0, len(calib_fts), bs):
+            net(calib_fts[i:i+bs])
+    torch.quantization.convert(trunk, inplace = True)
+    return net
+
+def leading_conv_blocks(layers):
+    '''the leading Conv2d, BatchNorm2d, ReLU layers of a Sequential'''
+    n = 0
+    while n + 2 < len(layers) and isinstance(layers[n], nn.Conv2d) \
+            and isinstance(layers[n+1], nn.BatchNorm2d) and isinstance(layers[n+2], nn.ReLU):
+        n += 3
+    return layers[:n]
+
+def dataset_features(path, n, seed = 0):
+    '''features of n random positions from a NinebyNineGames csv'''
+    data = NinebyNineGames(path)
+    idx = np.random.RandomState(seed).choice(len(data), size = min(n, len(data)), replace = False)
+    return torch.stack([data[i][0] for i in idx])
+
+def quant_report(net, qnet, fts, reps = 50, bs = 64):
+    '''Compare an int8 network against its fp32 original on fts.
+    Returns a dict of top-1 move agreement, mean absolute value error,
+    single position latency (ms) and batch throughput (positions/s)'''
+    report = {}
+    with torch.no_grad():
+        out, q_out = net(fts), qnet(fts)
+        if isinstance(net, PolicyValueNet):
+            (p, v), (q_p, q_v) = out, q_out
+        elif isinstance(net, ValueNet):
+            p, v, q_p, q_v = None, out, None, q_out
+        else:
+            p, v, q_p, q_v = out, None, q_out, None
+        if p is not None:
+            report["top-1 agreement"] = (p.argmax(1) == q_p.argmax(1)).float().mean().item()
+        if v is not None:
+            report["value MAE"] = (v - q_v).abs().mean().item()
+        for name, m in (("fp32", net), ("int8", qnet)):
+            report[f"{name} latency (ms)"] = 1000 * timeit(lambda: m(fts[:1]), reps)
+            report[f"{name} throughput (pos/s)"] = bs / timeit(lambda: m(fts[:bs]), reps // 5 + 1)
+    return report
+
+def dual(args):
+    net = convert_dual(args.p, args.v)
+    torch.save({"model_state_dict": net.state_dict()}, args.o)
+    print(f"Wrote PolicyValueNet to {args.o}")
+
+def fuse(args):
+    net = load_net(args.p, NETS[args.m])
+    exported = freeze(fold_batchnorm(net))
+    err, t_net, t_exp = compare(net, exported)
+    print(f"max abs output difference: {err:.2e}")
+    print(f"single position latency: {1000*t_net:.2f} ms -> {1000*t_exp:.2f} ms")
+    if err > args.tol:
+        raise SystemExit(f"Exported model differs by more than {args.tol}; not saved")
+    torch.jit.save(exported, args.o)
+    print(f"Wrote TorchScript model to {args.o}")
+
+def quant(args):
+    net = load_net(args.p, NETS[args.m])
+    fts = dataset_features(args.d, args.n + args.eval)
+    calib_fts, eval_fts = fts[:args.n], fts[args.n:]
+    qnet = freeze(quantize(net, calib_fts, args.backend))
+    for k, val in quant_report(net, qnet, eval_fts).items():
+        print(f"{k:>26}: {val:.4f}")
+    out = args.o if args.o else int8_path(args.p)
+    torch.jit.save(qnet, out)
+    print(f"Wrote int8 TorchScript model to {out}")
+
+def weights(args):
+    net = load_net(args.p, NETS[args.m])
+    save_weights(net, args.o)
+    print(f"Wrote {args.m} weights ({os.path.getsize(args.p)/2**20:.1f} MB -> {os.path.getsize(args.o)/2**20:.1f} MB) to {args.o}")
+
+def int8_path(path):
+    '''default path of the int8 export of a checkpoint'''
+    root, ext = os.path.splitext(path)
+    return root + "_int8" + ext
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Convert and export Boke networks")
+    subparsers = parser.add_subparsers(dest = "export", required = True)
+
+    p = subparsers.add_parser("dual", help = "combine policy and value checkpoints into a PolicyValueNet")
+    p.add_argument("-p", metavar = "PATH", type = str, required = True, help = "path to policy checkpoint")
+    p.add_argument("-v", metavar = "PATH", type = str, help = "path to value net checkpoint")
+    p.add_argument("-o", metavar = "PATH", type = str, required = True, help = "output path")
+    p.set_defaults(func = dual)
+
+    p = subparsers.add_parser("fuse", help = "fold BatchNorm and freeze as TorchScript for inference")
+    p.add_argument("-p", metavar = "PATH", type = str, required = True, help = "path to checkpoint")
+    p.add_argument("-m", metavar = "MODEL", type = str, choices = NETS, default = "policy", help = "network type")
+    p.add_argument("-o", metavar = "PATH", type = str, required = True, help = "output path")
+    p.add_argument("--tol", type = float, default = 1e-4, help = "largest allowed output difference")
+    p.set_defaults(func = fuse)
+
+    p = subparsers.add_parser("quant", help = "int8 post-training quantization calibrated on csv positions")
+    p.add_argument("-p", metavar = "PATH", type = str, required = True, help = "path to checkpoint")
+    p.add_argument("-m", metavar = "MODEL", type = str, choices = NETS, default = "policy", help = "network type")
+    p.add_argument("-d", metavar = "DATA", type = str, required = True, help = "path to csv for calibration and evaluation")
+    p.add_argument("-n", type = int, default = 1024, help = "number of calibration positions")
+    p.add_argument("--eval", type = int, default = 1024, help = "number of held out positions for the report")
+    p.add_argument("--backend", type = str, choices = ["fbgemm", "qnnpack"], default = "fbgemm", help = "quantized engine")
+    p.add_argument("-o", metavar = "PATH", type = str, help = "output path (default <checkpoint>_int8.pt)")
+    p.set_defaults(func = quant)
+
+    p = subparsers.add_parser("weights", help = "weights only checkpoint that bokePlay.py memory maps")
+    p.add_argument("-p", metavar = "PATH", type = str, required = True, help = "path to checkpoint")
+    p.add_argument("-m", metavar = "MODEL", type = str, choices = NETS, default = "policy", help = "network type")
+    p.add_argument("-o", metavar = "PATH", type = str, required = True, help = "output path")
+    p.set_defaults(func = weights)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,5 +1,7 @@
-import re
+import sgf
 import itertools
+from operator import itemgetter
+import random
 from textwrap import wrap
 N = 9 
 WHITE, BLACK, EMPTY = 'O', 'X', '.'
@@ -129,16 +131,9 @@ class Game():
         return list(liberties)
 
     @staticmethod
-    def get_moves(sgf):
-        with open(sgf, 'r') as f:
-            match = re.findall(r";[BW]\[(\w\w)\]", f.read())
-        mvs = []
-        for mv in match:
-            if mv == '': 
-                mvs.append(-1)
-            else: 
-                mvs.append(9*(ord(mv[0])-97) + ord(mv[1])-97 )
-        return mvs
+    def get_moves(path):
+        '''moves of the first game in an sgf'''
+        return next(sgf.read(path)).moves
 
 def squash(c, alph = False):
     '''squash converts coordinate pair to single integer 0 <= n < N^2.
@@ -273,3 +268,84 @@ def possible_eye(board, sq_c):
         return None
     else:
         return color
+
+#The 8 symmetries of the board as maps of squashed coordinates, in the order
+#rotation by k*90 degrees clockwise, then its reflection in the main diagonal.
+#SYMMETRIES[k][sq_c] is where sq_c goes, INV_SYMMETRIES[k] maps it back
+def _rot(sq_c):
+    return (sq_c*N + N - 1 - sq_c//N) % (N*N)
+
+def _refl(sq_c):
+    x, y = divmod(sq_c, N)
+    return N*y + x
+
+SYMMETRIES = []
+for _k in range(4):
+    _r = list(range(N*N))
+    for _ in range(_k):
+        _r = [_rot(sq_c) for sq_c in _r]
+    SYMMETRIES += [_r, [_refl(sq_c) for sq_c in _r]]
+INV_SYMMETRIES = [[sym.index(sq_c) for sq_c in range(N*N)] for sym in SYMMETRIES]
+_BOARD_GETTERS = [itemgetter(*inv) for inv in INV_SYMMETRIES]
+
+def transform_board(board, k):
+    '''board after symmetry k'''
+    return ''.join(_BOARD_GETTERS[k](board))
+
+def transform_sq(sq_c, k):
+    '''sq_c after symmetry k. None and PASS are unchanged'''
+    if sq_c is None or sq_c == PASS:
+        return sq_c
+    return SYMMETRIES[k][sq_c]
+
+#positions before this turn are never adjudicated (selfplay.reinforce_batch
+#treats shorter games as broken)
+ADJUDICATE_TURN = 50
+
+def adjudicate(game):
+    '''Return game.score() if the result can no longer change, otherwise None.
+    The game is decided when no chain is in atari and either every empty region
+    is bordered by one color only, or one side's lead in stones alone is larger
+    than the number of empty points'''
+    if game.turn < ADJUDICATE_TURN:
+        return None
+    board = game.board
+    seen = set()
+    for sq_c, s in enumerate(board):
+        if s != EMPTY and sq_c not in seen:
+            stones, borders = flood_fill(board, sq_c)
+            if sum(board[sq_b] == EMPTY for sq_b in borders) < 2:
+                return None
+            seen |= stones
+    empties = board.count(EMPTY)
+    if abs(board.count(BLACK) - board.count(WHITE) - game.komi) > empties:
+        return game.score()
+    for sq_c, s in enumerate(board):
+        if s == EMPTY and sq_c not in seen:
+            region, borders = flood_fill(board, sq_c)
+            if len({board[sq_b] for sq_b in borders}) != 1:
+                return None
+            seen |= region
+    return game.score()
+
+#Zobrist hashing: xor of a fixed random 64 bit code for each feature of the position
+_rng = random.Random(9)
+ZOBRIST = {color: [_rng.getrandbits(64) for _ in range(N*N)] for color in (BLACK, WHITE)}
+ZOBRIST_KO = [_rng.getrandbits(64) for _ in range(N*N)]
+ZOBRIST_LAST = [_rng.getrandbits(64) for _ in range(N*N)]
+ZOBRIST_WHITE_TO_MOVE = _rng.getrandbits(64)
+
+def position_hash(game):
+    '''64 bit hash of the network input of game: stones, ko, side to move and last move.
+    Never 0, so 0 can mark an empty hash table slot'''
+    h = 0
+    for sq_c, s in enumerate(game.board):
+        if s != EMPTY:
+            h ^= ZOBRIST[s][sq_c]
+    if game.ko is not None:
+        h ^= ZOBRIST_KO[game.ko]
+    if isinstance(game.last_move, int) and game.last_move >= 0:
+        h ^= ZOBRIST_LAST[game.last_move]
+    if game.turn % 2:
+        h ^= ZOBRIST_WHITE_TO_MOVE
+    return h or 1
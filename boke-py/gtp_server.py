@@ -0,0 +1,226 @@
+'''Serves many GTP games at once over TCP or a Unix socket. Every connection is a
+session with its own board and search tree. The searches run in a thread pool and
+share one evaluator.BatchEvaluator, so the positions that concurrent searches
+evaluate at the same time go through the network in one batch.
+Sessions answer the GTP commands of bokePlay.py --mode gtp, plus boke-stats: the
+session's genmove latencies and the server's nodes/second and batch sizes'''
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import numpy as np
+import torch
+import go
+from bokeNet import PolicyNet, PolicyValueNet, load_net
+from evaluator import BatchEvaluator
+from mcts import MCTS, Go_MCTS
+import cpu_sched
+
+COMMANDS = ["protocol_version", "name", "version", "known_command", "list_commands", "quit", "boardsize",
+            "clear_board", "komi", "play", "genmove", "showboard", "final_score", "boke-stats"]
+COLORS = {"b": 0, "black": 0, "w": 1, "white": 1}
+
+def format_stats(stats):
+    '''key=value text of a stats dict, as answered to boke-stats'''
+    return " ".join(f"{k.replace(' ', '_')}={v:.1f}" if isinstance(v, float) else f"{k.replace(' ', '_')}={v}"
+                    for k, v in stats.items())
+
+class Session():
+    '''Board, search tree and genmove latencies of one GTP connection'''
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+        self.tree = server.new_tree()
+        self.board = Go_MCTS(device = server.device)
+        self.latencies = [] # seconds per genmove
+        self.rollouts = 0
+
+    def summary(self):
+        lat = np.array(self.latencies)*1000
+        return {"genmoves": len(lat), "rollouts": self.rollouts,
+                "p50 ms": float(np.percentile(lat, 50)) if len(lat) else None,
+                "max ms": float(lat.max()) if len(lat) else None}
+
+    def genmove(self):
+        '''Search the current position and play the chosen move. Runs in the server's thread pool'''
+        n = self.server.rollouts
+        self.tree.do_rollout(self.board, n)
+        self.board = self.tree.choose(self.board)
+        self.tree.prune(self.board)
+        return n
+
+    async def command(self, line):
+        '''The response to a line of GTP, and whether the session is over'''
+        cmd = line.split()
+        if not cmd:
+            return "", False
+        cmd_id = ""
+        if cmd[0].isdigit():
+            cmd_id, cmd = cmd[0], cmd[1:]
+        if not cmd:
+            return f"?{cmd_id} empty command\n\n", False
+        name, cmd_args = cmd[0], cmd[1:]
+        try:
+            out = await self.run(name, cmd_args)
+        except go.IllegalMove:
+            return f"?{cmd_id} illegal move\n\n", False
+        except IndexError:
+            return f"?{cmd_id} missing argument\n\n", False
+        except ValueError as e:
+            return f"?{cmd_id} {e}\n\n", False
+        return f"={cmd_id} {out}\n\n", name == "quit"
+
+    async def run(self, name, args):
+        '''Execute GTP command name. Raises ValueError with the error message of a failure'''
+        if name not in COMMANDS:
+            raise ValueError("unknown command")
+        if name == "protocol_version":
+            return "2"
+        if name == "name":
+            return "boke"
+        if name == "version":
+            return "0.2-alpha"
+        if name == "known_command":
+            return "true" if args and args[0] in COMMANDS else "false"
+        if name == "list_commands":
+            return "\n".join(COMMANDS)
+        if name == "quit":
+            return ""
+        if name == "boardsize":
+            if int(args[0]) != go.N:
+                raise ValueError(f"Boke only plays on boardsize {go.N}")
+            return ""
+        if name == "clear_board":
+            #the tree keeps what it learned about the empty board
+            self.board = Go_MCTS(device = self.server.device, komi = self.board.komi)
+            self.tree.prune(self.board)
+            return ""
+        if name == "komi":
+            self.board.komi = float(args[0])
+            return ""
+        if name == "showboard":
+            return "\n" + str(self.board)
+        if name == "final_score":
+            score = self.board.score()
+            return f"B+{score}" if score > 0 else f"W+{-score}"
+        if name == "boke-stats":
+            return format_stats({**self.summary(), **self.server.summary()})
+        if args[0].lower() not in COLORS:
+            raise ValueError("invalid color")
+        if COLORS[args[0].lower()] != self.board.turn%2:
+            raise ValueError(f"it is not {args[0]}'s turn")
+        if name == "play":
+            move = go.PASS if args[1].upper() == "PASS" else go.squash(args[1].upper(), alph = True)
+            self.board = self.board.make_move(move)
+            self.tree.prune(self.board)
+            return ""
+        #genmove; always pass once the opponent has
+        if self.board.terminal:
+            return "PASS"
+        start = perf_counter()
+        n = await asyncio.get_running_loop().run_in_executor(self.server.executor, self.genmove)
+        self.latencies.append(perf_counter() - start)
+        self.rollouts += n
+        self.server.nodes += n
+        return "PASS" if self.board.last_move == go.PASS else go.unsquash(self.board.last_move, alph = True)
+
+class GTPServer():
+    '''Owns the network, behind a BatchEvaluator shared by every session, and the thread
+    pool the sessions search in (at most workers searches at a time)'''
+    def __init__(self, net, dual = False, rollouts = 100, workers = 8, max_batch = 64, max_wait = 0.002,
+                 cache_size = 65536, gnu = True, device = torch.device("cpu")):
+        self.evaluator = BatchEvaluator(net, max_batch, max_wait, device)
+        self.executor = ThreadPoolExecutor(workers)
+        self.dual = dual
+        self.rollouts = rollouts
+        self.cache_size = cache_size
+        self.gnu = gnu
+        self.device = device
+        self.sessions = []
+        self.connections = 0
+        self.nodes = 0 # rollouts of every session
+        self.start = perf_counter()
+
+    def new_tree(self):
+        nets = {"policy_value_net": self.evaluator} if self.dual else {"policy_net": self.evaluator}
+        return MCTS(exploration_weight = 0.5, cache_size = self.cache_size, gnu = self.gnu, **nets)
+
+    def summary(self):
+        stats = self.evaluator.stats()
+        batches = max(stats["batches"], 1)
+        sizes = stats["batch sizes"]
+        return {"sessions": len(self.sessions), "nodes/s": self.nodes/(perf_counter() - self.start),
+                "mean batch": sum(k*v for k, v in sizes.items())/batches, "eval p50 ms": stats["p50 ms"] or 0.0}
+
+    async def serve_session(self, reader, writer):
+        self.connections += 1
+        session = Session(self, f"session {self.connections}")
+        self.sessions.append(session)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response, done = await session.command(line.decode("utf-8", errors = "replace"))
+                writer.write(response.encode())
+                await writer.drain()
+                if done:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.remove(session)
+            writer.close()
+            print(f"{session.name} closed: {format_stats(session.summary())}", flush = True)
+
+    async def report(self, interval):
+        '''Print the latency of every session and the nodes/second of the last interval seconds'''
+        last = self.nodes
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.evaluator.stats()
+            print(f"{(self.nodes - last)/interval:.1f} nodes/s, {len(self.sessions)} sessions, "
+                  f"batch sizes {stats['batch sizes']}, eval p50 {stats['p50 ms'] or 0:.2f} ms", flush = True)
+            for session in self.sessions:
+                print(f"  {session.name}: {format_stats(session.summary())}", flush = True)
+            last = self.nodes
+
+async def main(args):
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    cpu_sched.set_threads(args.threads or cpu_sched.plan(processes = 1).threads)
+    torch.set_grad_enabled(False)
+    net = load_net(args.d if args.d else args.p, PolicyValueNet if args.d else PolicyNet, device)
+    server = GTPServer(net, dual = bool(args.d), rollouts = args.r, workers = args.workers, max_batch = args.max_batch,
+                       max_wait = args.max_wait/1000, cache_size = args.cache, gnu = args.scorer == "gnugo", device = device)
+    if args.unix:
+        listener = await asyncio.start_unix_server(server.serve_session, args.unix)
+        address = args.unix
+    else:
+        listener = await asyncio.start_server(server.serve_session, args.host, args.port)
+        address = f"{args.host}:{args.port}"
+    print(f"serving GTP on {address}", flush = True)
+    if args.report:
+        reporter = asyncio.create_task(server.report(args.report))
+    async with listener:
+        await listener.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Serve GTP games to many clients with one shared network")
+    parser.add_argument("-p", metavar = "PATH", type = str, default = "v0.2/RL_policy_29.pt", help = "path to policy (checkpoint, export.py weights or TorchScript)")
+    parser.add_argument("-d", metavar = "PATH", type = str, help = "path to policy-value net (replaces -p)")
+    parser.add_argument("-r", metavar = "ROLLOUTS", type = int, default = 100, help = "rollouts per genmove")
+    parser.add_argument("--host", type = str, default = "localhost", help = "TCP address to listen on")
+    parser.add_argument("--port", type = int, default = 5556, help = "TCP port")
+    parser.add_argument("--unix", metavar = "PATH", type = str, default = None, help = "listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type = int, default = 8, help = "searches running at the same time")
+    parser.add_argument("--max-batch", type = int, default = 64, help = "largest evaluator batch (positions)")
+    parser.add_argument("--max-wait", metavar = "MS", type = float, default = 2, help = "longest wait for a batch to fill, in milliseconds")
+    parser.add_argument("--cache", metavar = "SIZE", type = int, default = 65536, help = "positions in each session's evaluation cache (0 disables it)")
+    parser.add_argument("--scorer", type = str, choices = ["gnugo", "local"], default = "gnugo", help = "score rollouts with gnugo or go.Game.score")
+    parser.add_argument("--threads", type = int, default = None, help = "torch threads (default: all cores, at most cpu_sched.MAX_THREADS)")
+    parser.add_argument("--report", metavar = "SECONDS", type = float, default = 60, help = "seconds between reports (0: none)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
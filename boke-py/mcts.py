@@ -6,7 +6,7 @@ from selfplay import gnu_score
 import time
 import torch
 
-from bokeNet import ValueNet, value, PolicyNet, policy_dist, features
+from bokeNet import ValueNet, PolicyNet, PolicyValueNet, EvalCache, features, policy_dist_batch, value_batch, policy_value_batch, sample_probs
 import go
 
 MAX_TURNS = 90 
@@ -20,16 +20,56 @@ class MCTS:
                  value_net: ValueNet=None,
                  policy_net: PolicyNet=None,
                  exploration_weight=1,
-                 value_net_weight=0.5):
+                 value_net_weight=0.5,
+                 batch_expand=False,
+                 policy_value_net: PolicyValueNet=None,
+                 cache_size=65536,
+                 adjudicate=True,
+                 gnu=True):
         self.Q = defaultdict(int)  # total reward of each node
         self.N = defaultdict(int)  # total visit count for each node
         self.V = defaultdict(int)  # accumulated value net evaluations
         self.children = dict()  # children of each node
-        self.value_net = value_net
-        self.policy_net = policy_net
         self.exploration_weight = exploration_weight
         self.value_net_weight = value_net_weight
         self.winrate = None 
+        self.batch_expand = batch_expand # evaluate all new children in one forward
+        # network evaluations shared by every node and kept across moves
+        self.cache = EvalCache(cache_size) if cache_size else None
+        self.adjudicate = adjudicate # stop rollouts once go.adjudicate decides them
+        self.gnu = gnu # score rollouts with gnugo rather than go.Game.score
+        self.set_nets(value_net, policy_net, policy_value_net)
+
+    def set_nets(self, value_net=None, policy_net=None, policy_value_net=None):
+        """Search with new networks from now on, e.g. a newer checkpoint of the same ones.
+        The evaluations of the previous networks, in the cache and on the nodes of the
+        tree, are dropped; visit counts and rewards are kept"""
+        self.value_net = value_net
+        self.policy_net = policy_net
+        self.policy_value_net = policy_value_net
+        if policy_value_net is not None:
+            # one shared trunk serves both roles
+            self.value_net = self.policy_net = policy_value_net
+        if self.cache is not None:
+            self.cache.clear()
+        for node in list(self.N) + [n for children in self.children.values() for n in children]:
+            node.dist = node.value = None
+
+    def prune(self, root):
+        """Drop the statistics of every node outside the subtree of root, e.g. once a move
+        has been played from the previous root. Returns the visits of root kept"""
+        keep = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node not in keep:
+                keep.add(node)
+                stack.extend(self.children.get(node, ()))
+        for stats in (self.Q, self.N, self.V):
+            for node in [n for n in stats if n not in keep]:
+                del stats[node]
+        self.children = {n: c for n, c in self.children.items() if n in keep}
+        return self.N.get(root, 0)
 
     def choose(self, node):
         "Choose the best successor of node. (Choose a move in the game)"
@@ -47,21 +87,22 @@ class MCTS:
         # Choose most visited node
         best = max(self.children[node], key=score)
         self.winrate = self.Q[best]/self.N[best]
-        print( self.Q[best] , self.Q[best])
         return best
 
     def do_rollout(self, node, n = 1):
         "Train for n iterations"
+        node.cache = self.cache
         for _ in range(n):
             # Get path to leaf of current search tree
             path = self._descend(node)
             leaf = path[-1]
-            if leaf.features is None:
-                leaf.set_features()
-            if self.value_net and not leaf.value:
+            if self.policy_value_net is not None:
+                if leaf.dist is None or leaf.value is None:
+                    leaf.set_eval(self.policy_value_net)
+            elif self.value_net and leaf.value is None:
                 leaf.set_value(self.value_net)
             # Get result of rollout starting from leaf
-            score = self._simulate(leaf, gnu = True)
+            score = self._simulate(leaf, gnu = self.gnu)
             self._backpropagate(path, score, leaf.value)
 
     def _descend(self, node):
@@ -84,6 +125,8 @@ class MCTS:
         if node in self.children:
             return  # already expanded
         self.children[node] = node.find_children(self.policy_net)
+        if self.batch_expand:
+            set_dists(self.children[node], self.policy_net)
 
     # Need to make this faster (ideally at least 10x)
     def _simulate(self, node, gnu = False):
@@ -91,6 +134,10 @@ class MCTS:
         optional: gnu = True scores with gnugo'''
         invert_reward = not node.color
         while True:
+            #a decided position has its final score already, no need to score it again
+            score = go.adjudicate(node) if self.adjudicate else None
+            if score is not None:
+                return invert_reward^int(score > 0)
             if node.terminal:
                 reward = node.reward(gnu)
                 reward = invert_reward^reward
@@ -119,7 +166,7 @@ class MCTS:
         if node.dist is None:
             node.set_dist(self.policy_net)
         def puct(n):
-            last_move_prob = node.dist.probs[n.last_move].item()
+            last_move_prob = node.dist[n.last_move]
             if not self.value_net is None:
                 avg_reward = 0 if self.N[n] == 0 else ((1 - self.value_net_weight) * self.Q[n]
                                                         + self.value_net_weight * self.V[n]) / self.N[n]
@@ -132,6 +179,22 @@ class MCTS:
         return max(self.children[node], key=puct)
 
 
+def set_dists(nodes, policy: PolicyNet):
+    '''Set the probability distributions of non-terminal nodes with
+    one batched forward pass'''
+    nodes = [n for n in nodes if n.dist is None and not n.terminal and not n.cached_dist()]
+    if not nodes:
+        return
+    for n in nodes:
+        if n.features is None:
+            n.set_features()
+    fts = torch.stack([n.features for n in nodes])
+    probs = policy_dist_batch(policy, device = nodes[0].device, fts = fts)
+    for n, p in zip(nodes, probs):
+        n.dist = p
+        n.cache_put(EvalCache.POLICY, p)
+
+
 class Go_MCTS(go.Game):
     """Wraps go.Game to turn it into a node for search tree expansion
     in MCTS
@@ -146,7 +209,7 @@ class Go_MCTS(go.Game):
     """
     def __init__(self, board=go.EMPTY_BOARD, ko=None, turn=0, moves=[],
                  sgf=None, terminal=False,
-                 color=True, last_move=None, komi = 5.5, device = "cpu"):
+                 color=True, last_move=None, komi = 5.5, device = "cpu", cache = None):
         super().__init__(board, ko, last_move, turn, moves, komi, sgf)
         self.terminal = terminal 
         self.color = color
@@ -154,6 +217,7 @@ class Go_MCTS(go.Game):
         self.features = None
         self.value = None
         self.device = device
+        self.cache = cache # EvalCache shared with the rest of the search
 
     def __eq__(self, other):
         return self.board == other.board
@@ -165,7 +229,7 @@ class Go_MCTS(go.Game):
         return Go_MCTS(board=self.board, ko=self.ko, turn=self.turn,
                        moves=self.moves, terminal=self.terminal,
                        color=self.color, last_move=self.last_move,
-                       komi = self.komi, device = self.device)
+                       komi = self.komi, device = self.device, cache = self.cache)
     
     def find_children(self, policy):
         '''Returns a set of boards (Go_MCTS objects) derived from legal
@@ -185,9 +249,8 @@ class Go_MCTS(go.Game):
 
     def topk_moves(self, policy: PolicyNet, k):
         if self.dist is None:
-            self.set_dist()
-        topk = torch.topk(self.dist.probs, k = k).indices
-        return topk.tolist()
+            self.set_dist(policy)
+        return self.dist.argsort()[::-1][:k].tolist()
 
     def reward(self, gnu = False):
         '''Returns 1 if Black wins, 0 if White wins.'''
@@ -221,17 +284,35 @@ class Go_MCTS(go.Game):
         '''Terminate after MAX_TURNS or if last move is PASS''' 
         return self.turn > MAX_TURNS or self.last_move == -1
 
+    def position_key(self):
+        '''Key of the position for the evaluation cache. The last move is part
+        of the network input, so it is part of the key'''
+        return (self.board, self.ko, self.turn % 2, self.last_move)
+
+    def cached_dist(self):
+        '''Set the move probabilities from the cache. Returns True on a hit'''
+        if self.cache is not None:
+            self.dist = self.cache.get(self.position_key(), EvalCache.POLICY)
+        return self.dist is not None
+
+    def cache_put(self, field, val):
+        if self.cache is not None:
+            self.cache.put(self.position_key(), field, val)
+
     def set_dist(self, policy: PolicyNet):
-        '''Set the probability distribution for this board'''
+        '''Set the (81,) np.ndarray of move probabilities for this board'''
+        if self.cached_dist():
+            return
         if self.features is None:
             self.set_features()
-        self.dist = policy_dist(policy, self, device = self.device, fts=self.features)
+        self.dist = policy_dist_batch(policy, device = self.device, fts=self.features.unsqueeze(0))[0]
+        self.cache_put(EvalCache.POLICY, self.dist)
     
     def dist_sample(self, policy: PolicyNet):
         '''Sample a move from the policy distribution'''
         if self.dist is None:
             self.set_dist(policy)
-        return self.dist.sample().item()
+        return int(sample_probs(self.dist)[0])
 
     def set_features(self):
         '''Set the policy features for this board'''
@@ -239,4 +320,25 @@ class Go_MCTS(go.Game):
 
     def set_value(self, value_net: ValueNet):
         '''Set the value net valuation for this board'''
-        self.value = value(value_net, self, device = self.device, fts=self.features)
+        if self.cache is not None:
+            self.value = self.cache.get(self.position_key(), EvalCache.VALUE)
+            if self.value is not None:
+                return
+        if self.features is None:
+            self.set_features()
+        self.value = value_batch(value_net, device = self.device, fts=self.features.unsqueeze(0))[0].item()
+        self.cache_put(EvalCache.VALUE, self.value)
+
+    def set_eval(self, net: PolicyValueNet):
+        '''Set the move probabilities and valuation for this board with one
+        forward pass of a PolicyValueNet'''
+        if self.cache is not None:
+            self.value = self.cache.get(self.position_key(), EvalCache.VALUE)
+            if self.value is not None and self.cached_dist():
+                return
+        if self.features is None:
+            self.set_features()
+        probs, vals = policy_value_batch(net, device = self.device, fts=self.features.unsqueeze(0))
+        self.dist, self.value = probs[0], vals[0].item()
+        self.cache_put(EvalCache.POLICY, self.dist)
+        self.cache_put(EvalCache.VALUE, self.value)
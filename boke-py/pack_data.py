@@ -0,0 +1,121 @@
+'''Packs a training csv from data/pre_process.py into the fixed record binary
+format read by bokeNet.PackedGames, so that training reads precomputed features
+from a memory map instead of replaying every position through go.Game.
+With --dedup, positions that are the same up to a symmetry of the board are
+aggregated into one record with the counts of the moves played from them'''
+import argparse
+import multiprocessing as mp
+from collections import Counter
+import numpy as np
+from tqdm import tqdm
+import go
+from bokeNet import NinebyNineGames, PACK_MAGIC, PACK_HEADER, PACK_RECORD, PACK_DEDUP_RECORD, pack_features, features
+import cpu_sched
+
+def pack_range(data, start, stop):
+    '''Records of the items start to stop of a NinebyNineGames'''
+    recs = np.zeros(stop - start, dtype = PACK_RECORD)
+    for k, idx in enumerate(range(start, stop)):
+        item = data[idx]
+        recs[k]["planes"] = pack_features(item[0])
+        recs[k]["move"] = item[1]
+        if data.with_result:
+            recs[k]["result"] = item[2]
+    return recs
+
+def image(board, ko, last, turn, k):
+    '''position key of (board, ko, last move, turn) after symmetry k'''
+    return (go.transform_board(board, k), go.transform_sq(ko, k), go.transform_sq(last, k), turn % 2)
+
+def canonical(board, ko, last, turn):
+    '''(key, k): the smallest of the 8 symmetric images of a position and a symmetry k giving it.
+    ko and last are -1 if there are none'''
+    return min((image(board, ko, last, turn, k), k) for k in range(len(go.SYMMETRIES)))
+
+def square(x):
+    '''a ko, last move or move column value as a square, -1 if there is none'''
+    x = NinebyNineGames.square(x)
+    return -1 if x is None or x < 0 else x
+
+def dedup(data):
+    '''Aggregate the positions of a NinebyNineGames by canonical key. Returns a list of
+    (key, [Counter of the moves played in the canonical orientation, occurrences, result sum])'''
+    positions = {}
+    for row in tqdm(data.boards.itertuples(index = False), total = len(data)):
+        board, ko, turn, last, move = row[:5]
+        move = square(move)
+        if move < 0:
+            continue # passes have no square in the policy target
+        key, k = canonical(board, square(ko), square(last), int(turn))
+        entry = positions.get(key)
+        if entry is None:
+            entry = positions[key] = [Counter(), 0, 0.0]
+        entry[0][go.SYMMETRIES[k][move]] += 1
+        entry[1] += 1
+        if data.with_result:
+            entry[2] += row[5]
+    return list(positions.items())
+
+def dedup_range(positions, start, stop):
+    '''Records of the deduplicated positions start to stop'''
+    recs = np.zeros(stop - start, dtype = PACK_DEDUP_RECORD)
+    for j, (key, (moves, n, result)) in enumerate(positions[start:stop]):
+        board, ko, last, turn = key
+        g = go.Game(board = board, ko = None if ko < 0 else ko, last_move = None if last < 0 else last, turn = turn)
+        recs[j]["planes"] = pack_features(features(g))
+        #symmetries that leave the position unchanged (e.g. all 8 for the empty board)
+        #make their images of a move equally likely
+        stabilizer = [k for k in range(len(go.SYMMETRIES)) if image(*key, k) == key]
+        counts = np.zeros(81, dtype = np.float64)
+        for move, c in moves.items():
+            for k in stabilizer:
+                counts[go.SYMMETRIES[k][move]] += c
+        top = np.iinfo(np.uint16).max
+        if counts.max() > top:
+            counts = np.maximum(np.round(counts*top/counts.max()), counts > 0)
+        recs[j]["counts"] = counts
+        recs[j]["n"] = n
+        recs[j]["result"] = result/n
+    return recs
+
+_data = None # the csv or its deduplicated positions, inherited by forked workers
+_pack = pack_range
+
+def _pack_chunk(bounds):
+    return _pack(_data, *bounds)
+
+def write_header(f, with_result, dedup = False):
+    f.write(PACK_MAGIC + bytes([with_result, dedup]) + bytes(PACK_HEADER - len(PACK_MAGIC) - 2))
+
+def pack(csv_path, out_path, workers = 1, chunk = 4096, dedup_positions = False):
+    '''Pack csv_path into out_path with `workers` processes. Returns the number of records'''
+    global _data, _pack
+    data = NinebyNineGames(csv_path)
+    if dedup_positions:
+        _data, _pack = dedup(data), dedup_range
+        print(f"{len(data)} positions, {len(_data)} distinct up to symmetry ({len(data)/max(len(_data), 1):.1f}x)")
+    else:
+        _data, _pack = data, pack_range
+    bounds = [(i, min(i + chunk, len(_data))) for i in range(0, len(_data), chunk)]
+    with open(out_path, "wb") as f:
+        write_header(f, data.with_result, dedup_positions)
+        if workers > 1:
+            with mp.get_context("fork").Pool(workers) as pool:
+                for recs in tqdm(pool.imap(_pack_chunk, bounds), total = len(bounds)):
+                    f.write(recs.tobytes())
+        else:
+            for b in tqdm(bounds):
+                f.write(_pack_chunk(b).tobytes())
+    return len(_data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Pack a training csv into a memory mappable dataset")
+    parser.add_argument("-i", metavar = "CSV", type = str, required = True, help = "csv or directory of csv shards from data/pre_process.py")
+    parser.add_argument("-o", metavar = "PATH", type = str, required = True, help = "output file (.pack)")
+    parser.add_argument("-j", metavar = "WORKERS", type = int, default = None, help = "worker processes (default one per core)")
+    parser.add_argument("--dedup", action = "store_true",
+                        help = "one record per position up to symmetry, with the distribution of moves played from it as the target")
+    args = parser.parse_args()
+    n = pack(args.i, args.o, args.j or cpu_sched.plan().processes, dedup_positions = args.dedup)
+    record = PACK_DEDUP_RECORD if args.dedup else PACK_RECORD
+    print(f"Packed {n} positions ({n*record.itemsize/2**20:.1f} MB)")
@@ -0,0 +1,87 @@
+'''Compact binary game records
+Each record is a fixed 16 byte header followed by one signed byte per move
+(0-80, pass = -1):
+    uint16  number of moves
+    int8    result: 1 if black won, 0 if white won, -1 if unknown
+    int8    reserved
+    int16   black player id (policy number, -1 if unknown)
+    int16   white player id
+    float32 komi
+    uint32  unix time the game finished'''
+import struct
+import time
+import threading
+from collections import namedtuple
+import torch
+import go
+from bokeNet import features
+
+HEADER = struct.Struct("<HbxhhfI")
+GameRecord = namedtuple("GameRecord", ["moves", "result", "black", "white", "komi", "time"])
+
+def game_record(moves, result, black = -1, white = -1, komi = 5.5):
+    return GameRecord(list(moves), -1 if result is None else int(result), black, white, komi, int(time.time()))
+
+def encode(rec: GameRecord):
+    return HEADER.pack(len(rec.moves), rec.result, rec.black, rec.white, rec.komi, rec.time) \
+        + struct.pack(f"<{len(rec.moves)}b", *rec.moves)
+
+def decode(buf, offset = 0):
+    '''Decode the record at offset in buf. Returns the GameRecord and the offset after it'''
+    n, result, black, white, komi, t = HEADER.unpack_from(buf, offset)
+    offset += HEADER.size
+    moves = list(struct.unpack_from(f"<{n}b", buf, offset))
+    return GameRecord(moves, result, black, white, komi, t), offset + n
+
+def decode_message(buf):
+    '''Decode a buffer holding exactly one record, e.g. a message from an actor. Raises
+    ValueError if it is truncated, has trailing bytes or fields out of range'''
+    try:
+        rec, end = decode(buf)
+    except struct.error as e:
+        raise ValueError(f"truncated game record ({e})")
+    if end != len(buf):
+        raise ValueError(f"{len(buf) - end} bytes after the game record")
+    if rec.result not in (-1, 0, 1) or any(not go.PASS <= mv < go.N*go.N for mv in rec.moves):
+        raise ValueError("game record fields out of range")
+    return rec
+
+def replay_features(moves, color = None):
+    '''Replay moves from the empty board and return the (N,27,9,9) input features of
+    the position before each move, or only before the moves of `color` ("black" or "white")'''
+    game = go.Game()
+    fts = []
+    for i, mv in enumerate(moves):
+        if color is None or i%2 == (color == "white"):
+            fts.append(features(game))
+        game.play_move(mv)
+    return torch.stack(fts)
+
+def read_records(path):
+    '''Yield the GameRecords of a shard file'''
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            n = HEADER.unpack(header)[0]
+            rec, _ = decode(header + f.read(n))
+            yield rec
+
+class ShardWriter():
+    '''Append-only writer of game records to a shard file. Safe to write to from
+    several threads (e.g. the callbacks of a selfplay.ScoringPool)'''
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "ab")
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, rec: GameRecord):
+        with self.lock:
+            self.f.write(encode(rec))
+            self.f.flush()
+            self.count += 1
+
+    def close(self):
+        self.f.close()
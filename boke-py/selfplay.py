@@ -2,18 +2,27 @@ import go
 import os
 import re
 import argparse
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from glob import glob
 from tqdm import trange
+import numpy as np
 from numpy.random import randint
 from copy import deepcopy
-from bokeNet import PolicyNet, policy_sample, policy_dist, features
+from contextlib import contextmanager
+from bokeNet import PolicyNet, features, policy_dist_batch, sample_probs
+from evaluator import EvaluatorProcess
+from shared_cache import SharedPolicyCache, report
+import cpu_sched
+import records
+from sgf import write_sgf, write_board_sgf
 from subprocess import Popen, PIPE
 import multiprocessing as mp
+from time import perf_counter
 import torch
 from torch.distributions.categorical import Categorical
 
 DEV= torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-SOFTMAX = torch.nn.Softmax(dim = 1)
 MAX_TURNS = 80 
 
 def playout(game: go.Game, pi_1, pi_2, device = DEV):
@@ -21,98 +30,67 @@ def playout(game: go.Game, pi_1, pi_2, device = DEV):
     while True:
         if game.turn > MAX_TURNS:
             break
-        mv1 = legal_sample(pi_1, game, device)
+        mv1 = legal_sample(pi_1, game, device = device)
         if mv1 is None:
             break 
         else:
-            game.play_move(mv1.item())
+            game.play_move(mv1)
         
-        mv2 = legal_sample(pi_2, game, device)        
+        mv2 = legal_sample(pi_2, game, device = device)        
         if mv2 is None:
             break 
         else:
-            game.play_move(mv2.item())
+            game.play_move(mv2)
 
-def legal_sample(pi, game: go.Game, return_fts = False, device = DEV):
+def legal_sample(pi, game: go.Game, return_fts = False, device = DEV, cache = None):
     '''Sample legal move from policy to play in board position `game`.
-    Returns torch.tensor containing coordinate 0-80 
+    Returns coordinate 0-80 (None if there is no legal move)
     args:
         pi: PolicyNet for sampling
         game: go.Game in board position to play from
     optional:
         return_fts: if True, return the input features 
-        device: torch.device'''
-    fts = features(game)
-    move = policy_sample(pi, game, device, fts = fts)
+        device: torch.device
+        cache: SharedPolicyCache of pi's probabilities'''
+    probs = None
+    if cache is not None:
+        h = go.position_hash(game)
+        probs = cache.get(h, game.turn)
+    fts = features(game) if probs is None or return_fts else None
+    if probs is None:
+        probs = policy_dist_batch(pi, device = device, fts = fts.unsqueeze(0))[0]
+        if cache is not None:
+            cache.put(h, probs)
+    move = legal_move(game, probs)
+    if move is None:
+        fts = None
+    if return_fts:
+        return move, fts
+    return move 
+
+def legal_move(game: go.Game, probs):
+    '''Sample a move from the (81,) array probs. If it is illegal or fills the
+    player's own eye, take the next best policy move instead.
+    Returns None if no move is acceptable'''
+    move = int(sample_probs(probs)[0])
     color = go.BLACK if game.turn%2 == 0 else go.WHITE
-    tries = 0
     k = 0
     #Don't play illegal move or fill own eyes
-    while not game.is_legal(move.item()) or go.possible_eye(game.board, move.item()) == color:
+    while not game.is_legal(move) or go.possible_eye(game.board, move) == color:
         if k == 0:
-            moves = torch.topk(policy_dist(pi, game, device, fts = fts).probs, k = 81).indices
+            moves = probs.argsort()[::-1]
         elif k > 80:
-            move, fts = None, None
-            break
-        move = moves[k]
+            return None
+        move = int(moves[k])
         k += 1
-    if return_fts:
-        return move, fts
-    return move 
-
-def write_board_sgf(game: go.Game, out_path):
-    '''write board to sgf (move sequence not available)'''
-    out = "(;GM[1]RU[Chinese]HA[0]SZ[9]KM[5.5]\n"
-    W = "AW"
-    B = "AB"
-    for i in range(81): 
-        mv = game.board[i]
-        if mv == 'X':
-            x, y = chr(i//9 + 97), chr(i%9 +97)
-            B += f"[{x}{y}]" 
-        elif mv == 'O':
-            x, y = chr(i//9 + 97), chr(i%9 +97)
-            W += f"[{x}{y}]" 
-    turn = 'B' if game.turn%2 == 0 else 'W' 
-    out += B + '\n' + W + f"PL[{turn}])"
-    with open(out_path, 'w') as f:
-        f.write(out)
-
-def write_sgf(moves, out_path, **kwargs): 
-    '''Write minimal sgf for moves list
-    args:
-        moves: list of moves in squashed coordinates (0 - 80), pass = -1
-        out_path: path to write to
-    kwargs:
-        B: name of black player
-        W: name of white player
-        result: result of game (e.g. "B+2.5")
-        '''
-    B = kwargs.get('B', '')
-    W = kwargs.get('W', '')
-    result = kwargs.get('result', '') 
-    out = f"(;GM[1]RU[Chinese]"
-    if B and W:
-        out += f"PB[{B}]PW[{W}]"
-    if result:
-        out += f"RE[{result}]"
-    out += "SZ[9]KM[5.5]\n"
-    turn = "B"
-    for mv in moves:
-        if mv == -1:
-            out += f";{turn}[]\n"
-        else:
-            x, y = chr(mv//9 + 97), chr(mv%9 +97)
-            out += f";{turn}[{x}{y}]\n"
-        turn = "W" if turn == "B" else "B" 
-    out += ")" 
-    with open(out_path, 'w') as f:
-        f.write(out)
+    return move
 
 def gnu_score(game):
     '''Scores the game using gnugo opened in a subprocess.
     Return 1 if black won, 0 if white won'''
-    temp = "/tmp/" + str(os.getpid())+".sgf" #put temp directory here
+    #unique per call, several threads of a ScoringPool share the pid
+    fd, temp = tempfile.mkstemp(suffix = ".sgf")
+    os.close(fd)
     write_board_sgf(game, temp) 
     p =Popen(["gnugo", "--komi", "5.5", "--mode", "gtp", "--chinese-rules", "-l", temp], \
                     stdin = PIPE, stdout = PIPE)
@@ -126,50 +104,200 @@ def gnu_score(game):
         return 1 if 'B' in res[0] else 0 
     return
 
-def self_play(pi_1, pi_2, num_games, get_fts_col, device = DEV):
-    '''Play `num_games` between pi_1 and pi_2. Returns list of game moves, list of results,
-    and list of inputs features for the specified color
+def local_score(game):
+    '''Scores the game with go.Game.score (no dead stone removal).
+    Return 1 if black won, 0 if white won'''
+    return int(game.score() > 0)
+
+def timed_score(scorer, game):
+    start = perf_counter()
+    return scorer(game), perf_counter() - start
+
+class ScoringPool():
+    '''Scores finished games in the background so that play continues while they are
+    scored. gnu_score mostly waits on the gnugo subprocess and runs in threads, other
+    scorers (local_score) are pure Python and run in worker processes. With workers = 0
+    games are scored synchronously, which only adds the timing.
+    Pass it as the scorer of self_play/self_play_batched'''
+    def __init__(self, scorer = gnu_score, workers = 2):
+        self.scorer = scorer
+        self.executor = None
+        if workers > 0:
+            executor = ThreadPoolExecutor if scorer is gnu_score else ProcessPoolExecutor
+            self.executor = executor(max_workers = workers)
+        self.score_time = 0.0 #seconds spent scoring, summed over the workers
+        self.wait_time = 0.0  #seconds play waited for results
+
+    def submit(self, game, callback = None):
+        '''Score game in the background. Returns a Future of (result, seconds);
+        callback(result) is called when the score is ready'''
+        if self.executor is None:
+            future = Future()
+            future.set_result(timed_score(self.scorer, game))
+            self.wait_time += future.result()[1]
+        else:
+            future = self.executor.submit(timed_score, self.scorer, game)
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(f.result()[0]))
+        return future
+
+    def join(self, futures):
+        '''Wait for the futures of submit and return their results'''
+        start = perf_counter()
+        done = [f.result() for f in futures]
+        self.wait_time += perf_counter() - start
+        self.score_time += sum(secs for _, secs in done)
+        return [result for result, _ in done]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures = True)
+
+@contextmanager
+def evaluating(net):
+    '''net in eval mode for the duration, then back in its previous mode. Playing in
+    train mode would normalize every BatchNorm over the whole lockstep batch, so each
+    game's moves would depend on the other games, and update the running statistics'''
+    training = net.training
+    net.eval()
+    try:
+        yield net
+    finally:
+        net.train(training)
+
+def self_play(pi_1, pi_2, num_games, train_col = None, device = DEV, cache = None, scorer = gnu_score,
+              writer = None, ids = (-1, -1), adjudicate = True):
+    '''Play `num_games` between pi_1 and pi_2. Returns list of game moves and list of results.
+    Input features are not kept; reinforce_batch regenerates them from the moves
     args:
         pi_1: PolicyNet that plays black
         pi_2: PolicyNet that plays white
-        get_fts_col: color of player to get input features for -- "black" or "white" '''
+    optional:
+        train_col: color of the player being trained -- "black" or "white". The other
+                   player is frozen, and only its probabilities go through cache
+        cache: SharedPolicyCache for the frozen player
+        scorer: function scoring a finished go.Game (gnu_score or local_score), or a
+                ScoringPool to score games in the background while the next ones are played
+        writer: records.ShardWriter each finished game is appended to
+        ids: (black, white) policy ids stored in the records
+        adjudicate: end games as soon as go.adjudicate decides them'''
     games = []
     results = []
-    fts_list = []
+    cache_1 = cache if train_col == "white" else None
+    cache_2 = cache if train_col == "black" else None
     for _ in range(num_games):
         game = go.Game()
-        game_fts = []
         while True:
-            if game.turn > MAX_TURNS:
+            if game.turn > MAX_TURNS or (adjudicate and go.adjudicate(game) is not None):
                 break
-            if get_fts_col == "black":
-                mv1, fts = legal_sample(pi_1, game, return_fts = True)
-                if fts is not None:
-                    game_fts.append(fts) 
-            else:
-                mv1 = legal_sample(pi_1, game)
-
+            mv1 = legal_sample(pi_1, game, device = device, cache = cache_1)
             if mv1 is None:
                 break 
             else:
-                game.play_move(mv1.item())
+                game.play_move(mv1)
             
-            if get_fts_col == "white":
-                mv2, fts = legal_sample(pi_2, game, return_fts = True)        
-                if fts is not None:
-                    game_fts.append(fts)
-            else:
-                mv2 = legal_sample(pi_2, game)
-
+            mv2 = legal_sample(pi_2, game, device = device, cache = cache_2)
             if mv2 is None:
                 break 
             else:
-                game.play_move(mv2.item())
-        fts_list.append(torch.stack(game_fts))
+                game.play_move(mv2)
         games.append(game.moves)
-        results.append(gnu_score(game))
+        results.append(finish(game, scorer, writer, ids))
+
+    return games, join_results(scorer, results)
+
+def self_play_batched(pi_1, pi_2, num_games, train_col = None, device = DEV, cache = None, scorer = gnu_score,
+                      writer = None, ids = (-1, -1), adjudicate = True):
+    '''Same as self_play, but all `num_games` are played in lockstep: each turn
+    runs one batched forward of pi_1 (or pi_2) over every unfinished game'''
+    games = [go.Game() for _ in range(num_games)]
+    results = [None] * num_games
+    active = list(range(num_games))
+    def retire(still_active):
+        #score the games that just ended, in the background with a ScoringPool
+        for i in set(active) - set(still_active):
+            results[i] = finish(games[i], scorer, writer, ids)
+        return still_active
+    while active:
+        active = retire([i for i in active if games[i].turn <= MAX_TURNS
+                         and not (adjudicate and go.adjudicate(games[i]) is not None)])
+        if not active:
+            break
+        active = retire(batched_step(pi_1, games, active, device, cache if train_col == "white" else None))
+        if not active:
+            break
+        active = retire(batched_step(pi_2, games, active, device, cache if train_col == "black" else None))
+    return [game.moves for game in games], join_results(scorer, results)
+
+def finish(game, scorer, writer = None, ids = (-1, -1)):
+    '''Score a finished game and append its record to writer. Returns the result,
+    or a Future of it if scorer is a ScoringPool'''
+    def write(result):
+        if writer is not None:
+            writer.write(records.game_record(game.moves, result, *ids, komi = game.komi))
+    if isinstance(scorer, ScoringPool):
+        return scorer.submit(game, write)
+    result = scorer(game)
+    write(result)
+    return result
+
+def join_results(scorer, results):
+    if isinstance(scorer, ScoringPool):
+        return scorer.join(results)
+    return results
+
+def batched_step(pi, games, active, device = DEV, cache = None):
+    '''Play one move of pi in each active game, evaluating all positions in one
+    forward pass after looking them up in cache. Returns the games that could move'''
+    probs = [None] * len(active)
+    if cache is not None:
+        hashes = [go.position_hash(games[i]) for i in active]
+        probs = [cache.get(h, games[i].turn) for h, i in zip(hashes, active)]
+    todo = [k for k, p in enumerate(probs) if p is None]
+    if todo:
+        fts = torch.stack([features(games[active[k]]) for k in todo])
+        for k, p in zip(todo, policy_dist_batch(pi, device = device, fts = fts)):
+            probs[k] = p
+            if cache is not None:
+                cache.put(hashes[k], p)
+    moved = []
+    for k, i in enumerate(active):
+        mv = legal_move(games[i], probs[k])
+        if mv is None:
+            continue
+        games[i].play_move(mv)
+        moved.append(i)
+    return moved
 
-    return games, results, fts_list
+def reinforce_batch(games, results, train_color):
+    '''Concatenate the positions pi played in a batch of self-play games into
+    one training batch, regenerating their features from the moves. Returns
+    (N,27,9,9) inputs, (N,) moves, (N,) rewards (+1 for positions from won games,
+    -1 for lost) and the number of wins. Games with an unknown result (None, or -1 in
+    a records.GameRecord, e.g. when scoring failed) are skipped. Inputs is None if
+    there is nothing to train on'''
+    inputs, pi_mvs, rewards = [], [], []
+    wins = 0
+    for mvs, result in zip(games, results):
+        if len(mvs) < 50: #learning has gone wrong
+            break
+        if result not in (0, 1):
+            continue
+        won = bool(result) == (train_color == "black")
+        own_mvs = mvs[::2] if train_color == "black" else mvs[1::2]
+        inputs.append(records.replay_features(mvs, train_color))
+        pi_mvs.extend(own_mvs)
+        rewards.extend([1.0 if won else -1.0] * len(own_mvs))
+        wins += won
+    if not inputs:
+        return None, None, None, wins
+    return torch.cat(inputs), torch.tensor(pi_mvs), torch.tensor(rewards), wins
+
+def reinforce_loss(pi, inputs, pi_mvs, rewards):
+    '''Reward weighted sum of the negative log probabilities of the moves pi played,
+    from one forward pass over the whole batch'''
+    log_probs = torch.log_softmax(pi(inputs), dim = 1)
+    return -(rewards * log_probs.gather(1, pi_mvs.unsqueeze(1)).squeeze(1)).sum()
 
 def reinforce(pi, pi_opp, optimizer, train_color, **kwargs):
     '''Implements the REINFORCE policy gradient descent algorithm using selfplay
@@ -183,54 +311,69 @@ def reinforce(pi, pi_opp, optimizer, train_color, **kwargs):
         bs: batch size of each iteration (default 16)
         device: torch.device for pi and pi_opp (default DEV) 
         stats: list to write winrate stats to
+        cache: SharedPolicyCache for pi_opp
+        cache_stats: list to write the cache's hit stats to
+        lockstep: play the batch with self_play_batched (default True)
+        sched: cpu_sched.Plan to pin this worker with, as worker number `rank`
+        shards: directory to append this worker's game records to
+        ids: (pi, pi_opp) policy ids stored in the records
+        scorer: function scoring finished games (default gnu_score)
+        score_workers: threads/processes scoring games in the background, 0 scores
+                       each game when it ends (default 2)
         '''
+    if kwargs.get("sched") is not None:
+        cpu_sched.pin(kwargs["sched"], kwargs.get("rank", 0))
     n_itrs = kwargs.get("n_itrs", 64)
     bs = kwargs.get("bs", 16)
     device = kwargs.get("device", DEV)
     stats = kwargs.get("stats")
+    cache = kwargs.get("cache")
+    play = self_play_batched if kwargs.get("lockstep", True) else self_play
+    writer = None
+    if kwargs.get("shards"):
+        writer = records.ShardWriter(os.path.join(kwargs["shards"], f"selfplay_{os.getpid()}.bin"))
+    pi_id, opp_id = kwargs.get("ids", (-1, -1))
+    pool = ScoringPool(kwargs.get("scorer", gnu_score), kwargs.get("score_workers", 2))
 
     winlist = []
+    samples, train_time, play_time = 0, 0.0, 0.0
     for itr in trange(n_itrs):
-        if train_color == "black":
-            games, results, fts_list = self_play(pi, pi_opp, bs, get_fts_col = train_color) 
-        elif train_color == "white":
-            games, results, fts_list = self_play(pi_opp, pi, bs, get_fts_col = train_color)
-        else:
-            raise ValueError("train_color must be black or white")
-
-        wins = 0 
-        for i in range(bs):
-            loss = 0.0 
-            mvs = games[i]
-            if len(mvs) < 50: #learning has gone wrong
-                break
-            reward = 1 if (results[i] and train_color == "black")\
-                        or (not results[i] and train_color == "white")  else -1
-            #calculate the loss
-            inputs = fts_list[i].to(device)
-            dists = SOFTMAX(pi(inputs))
-            pi_mvs = mvs[::2] if train_color == "black" else mvs[1::2]
-            pi_mvs = torch.tensor(pi_mvs).unsqueeze(1).to(device)
-            #sum of negative log probabilities of moves pi played
-            loss += -torch.log(torch.gather(dists, dim=1, index=pi_mvs)).sum()
-            loss *= reward
-
+        start = perf_counter()
+        with evaluating(pi):
             if train_color == "black":
-                wins += results[i]
+                games, results = play(pi, pi_opp, bs, train_color, cache = cache, scorer = pool, writer = writer, ids = (pi_id, opp_id))
+            elif train_color == "white":
+                games, results = play(pi_opp, pi, bs, train_color, cache = cache, scorer = pool, writer = writer, ids = (opp_id, pi_id))
             else:
-                wins += not results[i]
+                raise ValueError("train_color must be black or white")
+        play_time += perf_counter() - start
+
+        start = perf_counter()
+        inputs, pi_mvs, rewards, wins = reinforce_batch(games, results, train_color)
         winlist.append(wins)
 
+        if inputs is not None:
+            loss = reinforce_loss(pi, inputs.to(device), pi_mvs.to(device), rewards.to(device)) / bs
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            train_time += perf_counter() - start
+            samples += len(pi_mvs)
+
         if winlist and len(winlist)%10 == 0:
             avg_win = sum(winlist[-10:])/(bs*10)
-            print(f"Winrate ({train_color}): {avg_win:.2f}")
-
-        loss /= bs 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+            print(f"Winrate ({train_color}): {avg_win:.2f}, training {samples/max(train_time, 1e-9):.0f} samples/s")
+            #scoring that overlapped with play shows up as scoring time without waiting time
+            n = len(winlist)
+            print(f"Time per iteration ({train_color}): play {(play_time - pool.wait_time)/n:.2f}s, "
+                  f"waiting on scores {pool.wait_time/n:.2f}s ({pool.score_time/n:.2f}s scoring), train {train_time/n:.2f}s")
 
     stats.extend(winlist)
+    pool.close()
+    if writer is not None:
+        writer.close()
+    if cache is not None:
+        kwargs["cache_stats"].append(cache.stats())
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Script for self-play training")
@@ -238,6 +381,14 @@ if __name__ == "__main__":
     parser.add_argument("-b", help = "batch size", metavar = "B", type = int, dest = 'b', default = 16)
     parser.add_argument("-n", help = "number of iterations per epoch", metavar = "N", type = int, dest = 'n', default = 64)
     parser.add_argument("-f", help = "file to write stats to", metavar = "PATH", type = str, dest = 'f', default = "v0.3/RL_stats.txt")
+    parser.add_argument("--shared-cache", metavar = "SLOTS", type = int, default = 0, help = "size of the opponent policy cache shared by all workers (0 disables it)")
+    parser.add_argument("--sequential", action = "store_true", help = "play each iteration's games one at a time instead of in lockstep")
+    parser.add_argument("--evaluator", action = "store_true", help = "serve the opponent from one batching evaluator process shared by all workers")
+    parser.add_argument("--shards", metavar = "DIR", type = str, default = None, help = "directory to append the game records of every worker to")
+    parser.add_argument("--scorer", type = str, choices = ["gnugo", "local"], default = "gnugo", help = "score finished games with gnugo or go.Game.score")
+    parser.add_argument("--score-workers", type = int, default = 2, help = "threads/processes per worker scoring games in the background (0 scores synchronously)")
+    parser.add_argument("--workers", type = int, default = None, help = "number of worker processes (default one per core)")
+    parser.add_argument("--threads", type = int, default = None, help = "torch threads per worker")
     args = parser.parse_args()
 
     mp.set_start_method("spawn")
@@ -261,6 +412,14 @@ if __name__ == "__main__":
     pi.train()
     pi.share_memory()
 
+    #the evaluator process gets a core of its own
+    sched = cpu_sched.plan(args.workers, args.threads, reserve = 1 if args.evaluator else 0)
+    n_workers = max(sched.processes//2*2, 2) #half of workers train black, half train white
+    print(f"{n_workers} workers x {sched.threads} threads on {len(sched.cores)} cores")
+
+    cache = SharedPolicyCache(args.shared_cache) if args.shared_cache else None
+    if args.shards:
+        os.makedirs(args.shards, exist_ok = True)
     for epoch in range(args.e):
         print(f"Epoch: {epoch +1}") 
         pi_opp = PolicyNet()
@@ -272,22 +431,37 @@ if __name__ == "__main__":
         pi_opp.to(DEV)
         pi_opp.eval()
         
-        n_workers = mp.cpu_count()
         processes = []
         manager = mp.Manager()
         stat_list = manager.list()
+        cache_stats = manager.list()
+        if cache is not None:
+            cache.clear() #new opponent
+        if args.evaluator:
+            server = EvaluatorProcess(pi_opp, n_clients = n_workers, cores = sched.main_cores)
+            opps = [server.client(i) for i in range(n_workers)]
+        else:
+            opps = [pi_opp] * n_workers
 
-        #half of workers train black, half train white
-        for _ in range(n_workers//2):
-            keywords = {"n_itrs": args.n, "bs": args.b, "stats": stat_list}
-            p_b = mp.Process(target = reinforce, args = (pi, pi_opp, optimizer, "black"), kwargs = keywords)
-            p_w = mp.Process(target = reinforce, args = (pi, pi_opp, optimizer, "white"), kwargs = keywords)
+        for i in range(n_workers//2):
+            keywords = {"n_itrs": args.n, "bs": args.b, "stats": stat_list, "cache": cache, "cache_stats": cache_stats,
+                        "lockstep": not args.sequential, "sched": sched,
+                        "shards": args.shards, "ids": (n_opps, opp_id),
+                        "scorer": local_score if args.scorer == "local" else gnu_score, "score_workers": args.score_workers}
+            p_b = mp.Process(target = reinforce, args = (pi, opps[2*i], optimizer, "black"), kwargs = {**keywords, "rank": 2*i})
+            p_w = mp.Process(target = reinforce, args = (pi, opps[2*i+1], optimizer, "white"), kwargs = {**keywords, "rank": 2*i + 1})
             p_b.start()
             p_w.start()
             processes.append(p_b)
             processes.append(p_w)
         for p in processes:
             p.join()
+        if args.evaluator:
+            print(f"Opponent evaluator: {server.stats()}")
+            server.close()
+        if cache is not None:
+            print("Opponent policy cache:")
+            report(cache_stats)
         
         with open(args.f, 'a+') as f:
             f.write(f"Policy {n_opps} vs. Policy {opp_id}\n")
@@ -296,3 +470,5 @@ if __name__ == "__main__":
         n_opps += 1
         out_path = os.getcwd() + f"/v0.3/policy_{n_opps}.pt"
         torch.save({"model_state_dict":pi.state_dict(), "optimizer_state_dict":optimizer.state_dict()}, out_path)
+    if cache is not None:
+        cache.unlink()
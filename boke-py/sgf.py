@@ -0,0 +1,234 @@
+'''Reading and writing SGF. read() parses SGF files, collections of several games
+in one file, directories and .gz/.tar(.gz/.bz2/.xz)/.zip archives (read as streams,
+without extracting) incrementally, yielding one Game per game tree:
+    moves   main line in squashed coordinates (see go.squash), pass = -1
+    black   setup stones (AB), squashed
+    white   setup stones (AW), squashed
+    komi    KM, None if missing
+    result  RE as written, e.g. "B+2.5", None if missing (see winner())
+    size    SZ, 19 if missing
+Like the rest of the engine, the first letter of a point is the row.
+Only the first variation of each node is followed.'''
+import io
+import os
+import re
+import gzip
+import tarfile
+import zipfile
+from collections import namedtuple
+
+Game = namedtuple("Game", ["moves", "black", "white", "komi", "result", "size"])
+
+PASS = -1
+CHUNK = 1 << 16
+VALUE = r"\[[^\]\\]*(?:\\.[^\]\\]*)*\]"
+#one token: a run of nodes holding only a move, a property with its values, a tree
+#delimiter, a node delimiter (no group) or junk
+TOKEN = re.compile(r"\s*(?:((?:;\s*[BW]\s*\[[a-z]{0,2}\]\s*)+)|([A-Za-z]+)\s*((?:" + VALUE + r"\s*)+)|([()])|;|(.))", re.S)
+RUN, PROPERTY, DELIMITER, JUNK = 1, 3, 4, 5
+#the start of a token, cut off by the end of a chunk
+PARTIAL = re.compile(r"\s*;?\s*[A-Za-z]*\s*(?:" + VALUE + r"\s*)*(?:\[(?:[^\]\\]|\\.)*\\?)?\Z", re.S)
+VALUES = re.compile(VALUE[:2] + "(" + VALUE[2:-2] + ")" + VALUE[-2:], re.S)
+MOVES = re.compile(r"\[([a-z]{0,2})\]")
+ARCHIVES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".zip")
+EXTENSIONS = (".sgf", ".sgf.gz") + ARCHIVES
+
+def point(value, size):
+    '''squashed coordinate of an SGF point, PASS for "" (and "tt" on boards up to 19x19)'''
+    if value == "" or (value == "tt" and size <= 19):
+        return PASS
+    return size*(ord(value[0]) - 97) + ord(value[1]) - 97
+
+_point_tables = {}
+def point_table(size):
+    '''{SGF point: squashed coordinate} of every point and pass of a board size'''
+    if size not in _point_tables:
+        values = [""] + [a + b for a in map(chr, range(97, 123)) for b in map(chr, range(97, 123))]
+        _point_tables[size] = {v: point(v, size) for v in values}
+    return _point_tables[size]
+
+def points(value, size):
+    '''squashed coordinates of a point or of a compressed "aa:cc" rectangle of points'''
+    if ':' not in value:
+        return [point(value, size)]
+    (r1, c1), (r2, c2) = [(ord(v[0]) - 97, ord(v[1]) - 97) for v in value.split(':')]
+    return [size*r + c for r in range(min(r1, r2), max(r1, r2) + 1)
+                       for c in range(min(c1, c2), max(c1, c2) + 1)]
+
+def unescape(value):
+    return re.sub(r"\\(.)", r"\1", value, flags = re.S).strip()
+
+def tokens(stream, chunk = CHUNK):
+    '''(kind, text, values) of the move runs, properties and tree delimiters of a text
+    stream, read chunk characters at a time (see TOKEN)'''
+    buf, eof = "", False
+    while not eof:
+        data = stream.read(chunk)
+        eof = not data
+        buf += data
+        pos = 0
+        for m in TOKEN.finditer(buf):
+            kind = m.lastindex
+            if not eof and (m.end() == len(buf) or kind == JUNK or buf[m.end()] == '[') \
+                    and PARTIAL.match(buf, m.start()):
+                break # the rest of the token is in the next chunk
+            pos = m.end()
+            if kind == RUN:
+                yield kind, m.group(1), None
+            elif kind == PROPERTY:
+                yield kind, m.group(2).upper(), m.group(3)
+            elif kind == DELIMITER:
+                yield kind, m.group(4), None
+        buf = buf[pos:]
+
+def parse(stream, chunk = CHUNK):
+    '''Yield a Game for each game tree in a text stream'''
+    depth = 0
+    skip = 0 # depth of the variation being skipped, 0 if none
+    closed = [] # closed[d]: a variation at depth d+1 has been read
+    props = None
+    for kind, text, values in tokens(stream, chunk):
+        if skip:
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+                if depth < skip:
+                    skip = 0
+        elif kind != DELIMITER:
+            if props is not None:
+                props.append((text, values))
+        elif text == '(':
+            if depth and closed[depth - 1]:
+                depth += 1
+                skip = depth
+                continue
+            if depth == 0:
+                props = []
+            depth += 1
+            closed.append(False)
+        elif depth:
+            depth -= 1
+            closed.pop()
+            if depth:
+                closed[depth - 1] = True
+            else:
+                yield make_game(props)
+                props = None
+
+def make_game(props):
+    '''Game of the (property, values) of a main line. Runs of move nodes have values None'''
+    size = 19
+    for prop, values in props:
+        if prop == "SZ":
+            size = int(unescape(VALUES.match(values).group(1)).split(':')[0])
+            break
+    table = point_table(size)
+    moves, black, white, komi, result = [], [], [], None, None
+    for prop, values in props:
+        if values is None:
+            moves += map(table.__getitem__, MOVES.findall(prop))
+        elif prop == "B" or prop == "W":
+            moves.append(point(VALUES.match(values).group(1).strip(), size))
+        elif prop == "AB" or prop == "AW":
+            stones = black if prop == "AB" else white
+            for value in VALUES.findall(values):
+                stones += points(value.strip(), size)
+        elif prop == "KM":
+            try:
+                komi = float(unescape(VALUES.match(values).group(1)))
+            except ValueError:
+                pass
+        elif prop == "RE":
+            result = unescape(VALUES.match(values).group(1))
+    return Game(moves, black, white, komi, result, size)
+
+def winner(result):
+    '''"B" or "W" for a result like "B+R" or "W+0.5", None for draws, unknown or void results'''
+    if result and result[:2].upper() in ("B+", "W+"):
+        return result[0].upper()
+    return None
+
+def text(data):
+    '''text stream of the bytes of an archive member'''
+    return io.StringIO(data.decode("utf-8", errors = "replace"))
+
+def sources(path):
+    '''Yield (name, text stream) of every SGF file in path: an SGF file, a directory
+    (searched recursively) or an archive'''
+    if os.path.isdir(path):
+        for dirpath, _, names in os.walk(path):
+            for name in sorted(names):
+                if name.endswith(EXTENSIONS):
+                    yield from sources(os.path.join(dirpath, name))
+    elif path.endswith(".zip"):
+        with zipfile.ZipFile(path) as zf:
+            for name in zf.namelist():
+                if name.endswith(".sgf"):
+                    yield f"{path}/{name}", text(zf.read(name))
+    elif path.endswith(ARCHIVES):
+        #stream mode reads the archive front to back without seeking
+        with tarfile.open(path, "r|*") as tf:
+            for member in tf:
+                if member.isfile() and member.name.endswith(".sgf"):
+                    yield f"{path}/{member.name}", text(tf.extractfile(member).read())
+    elif path.endswith(".gz"):
+        with gzip.open(path, "rt", encoding = "utf-8", errors = "replace") as f:
+            yield path, f
+    else:
+        with open(path, "r", encoding = "utf-8", errors = "replace") as f:
+            yield path, f
+
+def read(path):
+    '''Yield a Game for every game in path (see sources())'''
+    for _, f in sources(path):
+        yield from parse(f)
+
+def write_board_sgf(game, out_path):
+    '''write the board of a go.Game to sgf (move sequence not available)'''
+    out = "(;GM[1]RU[Chinese]HA[0]SZ[9]KM[5.5]\n"
+    W = "AW"
+    B = "AB"
+    for i in range(81):
+        mv = game.board[i]
+        if mv == 'X':
+            x, y = chr(i//9 + 97), chr(i%9 +97)
+            B += f"[{x}{y}]"
+        elif mv == 'O':
+            x, y = chr(i//9 + 97), chr(i%9 +97)
+            W += f"[{x}{y}]"
+    turn = 'B' if game.turn%2 == 0 else 'W'
+    out += B + '\n' + W + f"PL[{turn}])"
+    with open(out_path, 'w') as f:
+        f.write(out)
+
+def write_sgf(moves, out_path, **kwargs):
+    '''Write minimal sgf for moves list
+    args:
+        moves: list of moves in squashed coordinates (0 - 80), pass = -1
+        out_path: path to write to
+    kwargs:
+        B: name of black player
+        W: name of white player
+        result: result of game (e.g. "B+2.5")
+        '''
+    B = kwargs.get('B', '')
+    W = kwargs.get('W', '')
+    result = kwargs.get('result', '')
+    out = f"(;GM[1]RU[Chinese]"
+    if B and W:
+        out += f"PB[{B}]PW[{W}]"
+    if result:
+        out += f"RE[{result}]"
+    out += "SZ[9]KM[5.5]\n"
+    turn = "B"
+    for mv in moves:
+        if mv == -1:
+            out += f";{turn}[]\n"
+        else:
+            x, y = chr(mv//9 + 97), chr(mv%9 +97)
+            out += f";{turn}[{x}{y}]\n"
+        turn = "W" if turn == "B" else "B"
+    out += ")"
+    with open(out_path, 'w') as f:
+        f.write(out)
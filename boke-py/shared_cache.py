@@ -0,0 +1,92 @@
+from collections import Counter
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+LOCK_STRIPES = 64
+
+#game phases for hit rate reporting: (first turn after the phase, name)
+PHASES = ((20, "opening"), (50, "middle game"), (None, "endgame"))
+
+def phase(turn):
+    for end, name in PHASES:
+        if end is None or turn < end:
+            return name
+
+class SharedPolicyCache():
+    '''Fixed size hash table of policy probabilities in multiprocessing.shared_memory,
+    keyed by go.position_hash and shared by every self-play worker.
+    Slots are direct mapped (a new position overwrites the old one in its slot).
+    Each slot has a sequence word, odd while the slot is being written. Writers hold
+    the lock of the slot's stripe of slots and make the word odd, write the key and the
+    probabilities, then make it even again. Readers take no lock: they only accept
+    probabilities if the word was even and unchanged around reading the key and copying
+    them, so a row that a writer touched in between is a miss.
+    Pickling a cache (e.g. as a Process argument) attaches to the same memory and locks'''
+    def __init__(self, n_slots = 1 << 16, name = None, locks = None):
+        self.n_slots = n_slots
+        size = n_slots * (8 + 8 + 81*4)
+        self.shm = SharedMemory(name = name, create = name is None, size = size)
+        self.keys = np.ndarray((n_slots,), dtype = np.uint64, buffer = self.shm.buf)
+        self.seqs = np.ndarray((n_slots,), dtype = np.uint64, buffer = self.shm.buf, offset = n_slots*8)
+        self.probs = np.ndarray((n_slots, 81), dtype = np.float32, buffer = self.shm.buf, offset = n_slots*16)
+        if name is None:
+            self.keys[:] = 0
+            self.seqs[:] = 0
+        self.locks = locks if locks is not None else [mp.Lock() for _ in range(LOCK_STRIPES)]
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def __getstate__(self):
+        return (self.n_slots, self.shm.name, self.locks)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def get(self, h, turn = 0):
+        '''Return a copy of the probabilities cached for hash h, or None'''
+        slot = h % self.n_slots
+        seq = int(self.seqs[slot])
+        if seq % 2 == 0 and self.keys[slot] == np.uint64(h):
+            probs = self.probs[slot].copy()
+            if self.seqs[slot] == seq:
+                self.hits[phase(turn)] += 1
+                return probs
+        self.misses[phase(turn)] += 1
+        return None
+
+    def put(self, h, probs):
+        slot = h % self.n_slots
+        with self.locks[slot % len(self.locks)]:
+            self.seqs[slot] += 1
+            self.keys[slot] = np.uint64(h)
+            self.probs[slot] = probs
+            self.seqs[slot] += 1
+
+    def clear(self):
+        for lock in self.locks:
+            lock.acquire()
+        self.keys[:] = 0
+        self.seqs[:] += 2
+        for lock in self.locks:
+            lock.release()
+
+    def stats(self):
+        '''lookups and hits of this process per game phase'''
+        return {name: (self.hits[name] + self.misses[name], self.hits[name]) for _, name in PHASES}
+
+    def close(self):
+        del self.keys, self.seqs, self.probs
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+def report(stats):
+    '''Print hit rates per phase from a list of SharedPolicyCache.stats() dicts'''
+    for _, name in PHASES:
+        lookups = sum(s[name][0] for s in stats)
+        hits = sum(s[name][1] for s in stats)
+        rate = hits/lookups if lookups else 0.0
+        print(f"  {name:>11}: {hits}/{lookups} hits ({rate:.1%} of network evaluations saved)")
@@ -0,0 +1,27 @@
+import pytest
+import torch
+import torch.nn as nn
+from evaluator import BatchEvaluator, EvaluatorProcess, EvaluatorError
+
+class FailingNet(nn.Module):
+    '''Raises on batches holding a position whose features are all -1'''
+    def forward(self, fts):
+        if (fts.flatten(1) == -1).all(1).any():
+            raise ValueError("bad position")
+        return fts.sum((1, 2, 3)).unsqueeze(1)
+
+def test_batch_evaluator_error():
+    ev = BatchEvaluator(FailingNet(), max_wait = 0)
+    with pytest.raises(EvaluatorError, match = "bad position"):
+        ev.submit(-torch.ones(1, 27, 9, 9)).result(timeout = 10)
+    #the evaluator survives the failed batch
+    assert ev.submit(torch.ones(2, 27, 9, 9)).result(timeout = 10).tolist() == [[81*27.0]]*2
+    ev.close()
+
+def test_evaluator_process_error():
+    ev = EvaluatorProcess(FailingNet(), 1, max_wait = 0)
+    client = ev.client(0)
+    with pytest.raises(EvaluatorError, match = "bad position"):
+        client.submit(-torch.ones(1, 27, 9, 9)).result(timeout = 30)
+    assert client.submit(torch.ones(1, 27, 9, 9)).result(timeout = 30).tolist() == [[81*27.0]]
+    ev.close()
@@ -0,0 +1,70 @@
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import pytest
+import torch
+from bokeNet import PolicyNet, save_weights
+
+SESSIONS = 4
+ANSWER = re.compile(r"([=?])(\d*)( [^\n]*)?(\n[^\n]+)*\n\n")
+
+@pytest.fixture
+def server(tmp_path):
+    '''Address of a gtp_server.py on a Unix socket, with a random policy'''
+    torch.manual_seed(0)
+    weights, address = str(tmp_path/"weights.pt"), str(tmp_path/"gtp.sock")
+    save_weights(PolicyNet(), weights)
+    proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gtp_server.py"),
+                             "-p", weights, "--unix", address, "-r", "4", "--workers", str(SESSIONS),
+                             "--scorer", "local", "--report", "0"],
+                            stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+    assert proc.stdout.readline().startswith("serving GTP on")
+    yield address
+    proc.kill()
+    proc.wait()
+
+COMMANDS = ["protocol_version", "known_command", "known_command genmove", "known_command undo",
+            "boardsize 19", "clear_board", "komi 7", "play B E5", "play W E5", "play W", "play X D4",
+            "genmove W", "genmove W", "genmove B", "showboard", "frobnicate", "boke-stats", "quit"]
+
+def session(address):
+    '''The answers to COMMANDS, a short game with some bad commands, with ids 1, 2, ...'''
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(address)
+    f = sock.makefile("rw")
+    answers = []
+    for i, command in enumerate(COMMANDS, 1):
+        f.write(f"{i} {command}\n")
+        f.flush()
+        answer = "".join(iter(f.readline, "\n")) + "\n"
+        assert ANSWER.fullmatch(answer) and answer[1:].startswith(f"{i} "), f"{command}: {answer!r}"
+        answers.append(answer)
+    assert f.readline() == "" # closed after quit
+    sock.close()
+    return answers
+
+def test_concurrent_sessions(server):
+    results, errors = [None]*SESSIONS, []
+    def client(i):
+        try:
+            results[i] = session(server)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target = client, args = (i,)) for i in range(SESSIONS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout = 120)
+    assert not errors, errors[0]
+    for answers in results:
+        assert answers[:4] == ["=1 2\n\n", "=2 false\n\n", "=3 true\n\n", "=4 false\n\n"]
+        assert answers[4].startswith("?5 ")
+        assert answers[7:11] == ["=8 \n\n", "?9 illegal move\n\n", "?10 missing argument\n\n", "?11 invalid color\n\n"]
+        assert re.fullmatch(r"=12 ([A-HJ][1-9]|PASS)\n\n", answers[11])
+        assert answers[12] == "?13 it is not W's turn\n\n"
+        assert re.fullmatch(r"=14 ([A-HJ][1-9]|PASS)\n\n", answers[13])
+        assert answers[15] == "?16 unknown command\n\n"
+        assert "genmoves=2" in answers[16]
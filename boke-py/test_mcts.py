@@ -0,0 +1,22 @@
+import os
+import go
+import sgf
+from mcts import MCTS, Go_MCTS
+
+GAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "bokevgnugo", "boke_gnugo_10.sgf")
+
+def test_simulate_keeps_adjudicated_score(monkeypatch):
+    game = next(sgf.read(GAME))
+    node = Go_MCTS()
+    for mv in game.moves:
+        node = node.make_move(mv)
+        if go.adjudicate(node) is not None:
+            break
+    score = go.adjudicate(node)
+    assert score is not None and not node.terminal
+    #gnu = True would start gnugo to score the position again
+    def reward(self, gnu = False):
+        raise AssertionError("adjudicated rollout scored again")
+    monkeypatch.setattr(Go_MCTS, "reward", reward)
+    tree = MCTS(gnu = True)
+    assert tree._simulate(node, gnu = True) == (not node.color) ^ int(score > 0)
@@ -0,0 +1,32 @@
+import os
+import sys
+import glob
+import json
+import shutil
+from collections import Counter
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+sys.path.append(DATA)
+import pre_process
+
+def rows(target_dir):
+    '''Counter of the position rows in the csv shards of target_dir'''
+    out = Counter()
+    for shard in glob.glob(os.path.join(target_dir, "*.csv")):
+        with open(shard) as f:
+            out.update(f.readlines()[1:])
+    return out
+
+def test_removed_sgf(tmp_path):
+    src, out = tmp_path/"sgf", tmp_path/"out"
+    src.mkdir()
+    for i in range(1, 5):
+        shutil.copy(os.path.join(DATA, "bokevgnugo", f"boke_gnugo_{i}.sgf"), src)
+    pre_process.pre_process(str(src), str(out), workers = 2)
+    before = rows(out)
+    os.remove(src/"boke_gnugo_1.sgf")
+    os.rename(src/"boke_gnugo_2.sgf", src/"renamed.sgf")
+    pre_process.pre_process(str(src), str(out), workers = 2)
+    pre_process.pre_process(str(src), str(tmp_path/"fresh"), workers = 1)
+    assert rows(out) == rows(tmp_path/"fresh") != before
+    with open(out/pre_process.MANIFEST) as f:
+        assert sorted(json.load(f)["files"]) == ["boke_gnugo_3.sgf", "boke_gnugo_4.sgf", "renamed.sgf"]
@@ -1,71 +1,132 @@
 import os
-from tqdm import tqdm, trange
+from time import perf_counter
+from datetime import timedelta
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from bokeNet import PolicyNet, ValueNet, NinebyNineGames 
+from bokeNet import PolicyNet, ValueNet, PolicyValueNet, load_dataset 
+import cpu_sched
 from datetime import date 
 import argparse 
 
 if __name__ == "__main__":    
     parser = argparse.ArgumentParser(description = "Supervise learning training script")
-    parser.add_argument("-d", metavar="DATA", type = str, nargs=1, help = "path to csv", required = True)
+    parser.add_argument("-d", metavar="DATA", type = str, nargs=1, help = "path to csv, directory of csv shards, or .pack file from pack_data.py", required = True)
     parser.add_argument("-c", metavar="CHECKPOINT", type = str, nargs = 1, help = "path to saved torch model")
     parser.add_argument("-e", metavar="EPOCHS", type = int, nargs =1, help = "number of epochs", default = [1])
+    parser.add_argument("-m", metavar="MODEL", type = str, choices = ["policy", "value", "dual"], default = "value",
+                        help = "network to train (dual needs a csv with a result column)")
+    parser.add_argument("-w", metavar="WEIGHT", type = float, default = 1.0, help = "value loss weight in the dual loss")
+    parser.add_argument("--no-augment", action = "store_true",
+                        help = "don't apply a random board symmetry to each position (for csvs written with pre_process.py --expand)")
+    parser.add_argument("--workers", type = int, default = None, help = "data loading processes (default a quarter of the cores, at most 8)")
+    parser.add_argument("-b", metavar = "BATCH", type = int, default = 32, help = "batch size")
+    parser.add_argument("--accum", type = int, default = 1, help = "batches per optimizer step (gradient accumulation)")
+    parser.add_argument("--prefetch", type = int, default = 4, help = "batches each loading worker prepares ahead")
+    parser.add_argument("--channels-last", action = "store_true", help = "NHWC memory format, usually faster convolutions on CPU")
+    parser.add_argument("--cpu", action = "store_true", help = "train on the CPU even if CUDA is available")
+    parser.add_argument("--report", type = int, default = 100, help = "batches between throughput reports")
     args = parser.parse_args() 
     
     print("Loading data...")
-    data = NinebyNineGames(args.d[0])
-    dataloader = DataLoader(data, batch_size = 32, shuffle = True, num_workers = 8) 
+    data = load_dataset(args.d[0], augment = not args.no_augment)
+    #each loading worker gets a core of its own, training threads get the rest
+    #(all of them when the data is loaded in the training process)
+    n_cores = len(cpu_sched.available_cores())
+    workers = args.workers if args.workers is not None else min(n_cores//4, 8)
+    loader_args = {}
+    if workers:
+        sched = cpu_sched.plan(workers, 1, reserve = n_cores - workers)
+        cpu_sched.pin_main(sched)
+        #persistent workers keep their processes (and memory maps) across epochs
+        loader_args = {"persistent_workers": True, "prefetch_factor": args.prefetch,
+                       "worker_init_fn": cpu_sched.worker_init(sched)}
+    else:
+        cpu_sched.set_threads(n_cores)
+    dataloader = DataLoader(data, batch_size = args.b, shuffle = True, num_workers = workers,
+                            collate_fn = data.collate_fn, **loader_args)
     #validation_set = NinebyNineGames("/home/jupyter/BokeGo/data/validation.csv") 
     #validloader = DataLoader(validation_set, batch_size = 128, shuffle = True, num_workers = 10)
     print("Number of board positions: {}".format(len(data)))
 
-    v = ValueNet()
-    v.cuda()
-    v.train()
-    err = nn.MSELoss()
-    #pi = PolicyNet()
-    #pi.cuda()
-    #err = nn.CrossEntropyLoss()      
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu") 
-    optimizer = torch.optim.Adam(v.parameters(), lr = 0.01)
+    device = torch.device("cuda:0" if torch.cuda.is_available() and not args.cpu else "cpu")
+    memory_format = torch.channels_last if args.channels_last else torch.preserve_format
+    #the policy targets are moves, or move distributions from a deduplicated pack
+    #(pack_data.py --dedup), which nn.CrossEntropyLoss takes as soft targets
+    if args.m == "dual":
+        net = PolicyValueNet()
+        if not data.with_result:
+            parser.error("dual training needs a csv with a result column (pre_process.py -r)")
+        policy_err = nn.CrossEntropyLoss()
+        value_err = nn.MSELoss()
+    elif args.m == "policy":
+        net = PolicyNet()
+        err = nn.CrossEntropyLoss()
+    else:
+        net = ValueNet()
+        err = nn.MSELoss()
+    net.to(device, memory_format = memory_format)
+    net.train()
+    optimizer = torch.optim.Adam(net.parameters(), lr = 0.01)
     if args.c:
         print("Loading checkpoint...")
         checkpt = torch.load(args.c[0], map_location = device)
-        v.load_state_dict(checkpt["model_state_dict"] )
-        optimizer.load_state_dict(checkpt["optimizer_state_dict"]) 
-        epochs_trained = checkpt["epoch"]
+        net.load_state_dict(checkpt["model_state_dict"] )
+        #checkpoints from export.py carry weights only
+        if "optimizer_state_dict" in checkpt:
+            optimizer.load_state_dict(checkpt["optimizer_state_dict"]) 
+        epochs_trained = checkpt.get("epoch", 0)
 
         for state in optimizer.state.values():
             for k, t in state.items():
                 if torch.is_tensor(t):
-                    state[k] = t.cuda()
-        v.train()
-        #pi.train()
+                    state[k] = t.to(device)
+        net.train()
     else:
         #policy = torch.load("v0.2/RL_policy_50.pt", map_location = device)
         #v.load_policy_dict(policy["model_state_dict"])
         epochs_trained = 0 
 
+    def report(i, n, samples, wait, compute, elapsed):
+        eta = timedelta(seconds = round((n - i - 1)*elapsed/(i + 1)))
+        print(f" Batch {i + 1}/{n}: {samples/elapsed:.0f} samples/s, "
+              f"data wait {wait/elapsed:.0%}, compute {compute/elapsed:.0%}, epoch ETA {eta}", flush = True)
+
     epochs = args.e[0] 
     for epoch in range(epochs):
         losses = []
         print("Epoch: {}".format(epochs_trained + 1))
         running_loss = 0.0
-        for i, data in tqdm(enumerate(dataloader,0)):
-            inputs, moves = data
-            inputs, moves = inputs.to(device), moves.to(device) 
+        n_batches = len(dataloader)
+        samples, wait, compute = 0, 0.0, 0.0
+        start = fetch_start = perf_counter()
+        optimizer.zero_grad()
+        for i, data in enumerate(dataloader,0):
+            fetched = perf_counter()
+            wait += fetched - fetch_start
+            inputs, moves = data[0].to(device, memory_format = memory_format), data[1].to(device)
             
-            optimizer.zero_grad()
-            outputs = v(inputs)
+            outputs = net(inputs)
             
             #backprop
-            loss = err(outputs, moves) 
-            loss.backward()
-            optimizer.step()
+            if args.m == "dual":
+                logits, values = outputs
+                results = data[2].float().to(device)
+                loss = policy_err(logits, moves) + args.w * value_err(values.view(-1), results)
+            else:
+                loss = err(outputs, moves) 
+            #gradients of accum batches add up to those of one accum times larger batch
+            (loss/args.accum).backward()
+            if (i + 1) % args.accum == 0 or i + 1 == n_batches:
+                optimizer.step()
+                optimizer.zero_grad()
         
             running_loss += loss.item()
+            samples += len(inputs)
+            fetch_start = perf_counter()
+            compute += fetch_start - fetched
+            if i % args.report == args.report - 1:
+                report(i, n_batches, samples, wait, compute, fetch_start - start)
             if i%1000 == 999:
                 print(" Loss: ", running_loss)
                 losses.append(running_loss)
@@ -84,10 +145,13 @@ if __name__ == "__main__":
                     #print(" Validation Loss: {}".format(valid_loss))
                # pi.train()
      
+        elapsed = perf_counter() - start
+        print(f"Epoch {epochs_trained + 1}: {samples} samples in {timedelta(seconds = round(elapsed))}, "
+              f"{samples/elapsed:.0f} samples/s, data wait {wait/elapsed:.0%}, compute {compute/elapsed:.0%}")
         epochs_trained += 1
-        out_path = os.getcwd() + "/value" \
+        out_path = os.getcwd() + "/" + {"policy": "policy", "value": "value", "dual": "policy_value"}[args.m] \
                     + str(date.today()) + "_" + str(epochs_trained)+ ".pt"  
-        torch.save({"model_state_dict": v.state_dict(), "optimizer_state_dict": optimizer.state_dict(), "epoch": epochs_trained}, out_path)
+        torch.save({"model_state_dict": net.state_dict(), "optimizer_state_dict": optimizer.state_dict(), "epoch": epochs_trained}, out_path)
         with open('stats.txt', 'a+') as f:
             f.write(f"Epoch: {epoch}\n")
             f.write(','.join([format(n, '.3f') for n in losses]) + '\n')
@@ -1,94 +1,150 @@
 #!/usr/bin/python3
+'''Turns a directory of SGFs (and .gz/.tar/.zip archives of them, see sgf.py) into a
+directory of csv shards of training positions, one shard per worker process per run.
+manifest.json records the SGF files already processed (by path, content hash and the
+shard holding their positions), so a rerun only processes new or changed files and adds
+their shards next to the existing ones. A shard holding a changed or removed file is rewritten'''
 import sys
 import os
-import re
+import json
+import hashlib
 import argparse
-import numpy as np
-from tqdm import tqdm 
+import multiprocessing as mp
+from time import perf_counter
 #path to go.py  
 sys.path.append(r"/home/jupyter/BokeGo/python")
 import go
+import sgf
 
+MANIFEST = "manifest.json"
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-i", type = str, required = True, metavar = "INPATH", nargs = 1, help = "input directory")
-parser.add_argument("-o", type = str, metavar = "OUTPATH", required = True, nargs = 1, help = "output directory")
-args = parser.parse_args()
+def positions(game, with_result = False, expand = False):
+    '''csv rows of the positions of an sgf.Game, none if it has no result (with_result),
+    fewer than 10 moves, or is not a 9x9 game from the empty board'''
+    result = None
+    if with_result:
+        result = sgf.winner(game.result)
+        if not result:
+            return
+        result = 1 if result == 'B' else -1
+    mvs = game.moves
+    if len(mvs) < 10 or game.size != go.N or game.black or game.white:
+        return
+    g = go.Game(moves = [], turn =0 , last_move = None)
+    for i in range(len(mvs)-1):
+        if mvs[i] != -1:
+            last = None if i == 0 else g.last_move
+            board, ko, move = g.board, g.ko, mvs[i]
+            for k in range(len(go.SYMMETRIES) if expand else 1):
+                yield data_str(go.transform_board(board, k), go.transform_sq(ko, k), i,
+                               go.transform_sq(last, k), go.transform_sq(move, k), result)
+        g.play_move(mvs[i])
 
-def pre_process(root_dir, target_dir):
-    sgf_files = [ s for s in os.scandir(root_dir) if s.path.endswith(".sgf")]
-    with open(target_dir, 'w') as f:
-        f.write("board,ko,turn,last,move\n")
-        for sgf in sgf_files: 
-            #result = get_result(sgf)
-            #if not result:
-            #    continue
-            mvs = get_moves(sgf)
-            if len(mvs) < 10:
-                continue
-            g = go.Game(moves = [], turn =0 , last_move = None)
-            #rand = np.random.randint(2, len(mvs),size = 5)
-            for i in range(len(mvs)-1):
-                if mvs[i] != -1:
-                    last = None if i == 0 else g.last_move
-                    board, ko, move = g.board, g.ko, mvs[i]
-                    for k in range(4):
-                        f.write(data_str(board, ko, i, last, move))
-                        f.write(data_str(refl(board), refl(ko), i, refl(last), refl(move)))
-                        board, ko, last , move= rot(board), rot(ko), rot(last), rot(move)
-                g.play_move(mvs[i])
-        print(go.unsquash(g.moves))
-enc  = {go.EMPTY : 0, go.BLACK: 1, go.WHITE: -1}
-dec = {0: go.EMPTY, 1: go.BLACK, -1: go.WHITE}
+def header(with_result):
+    return "board,ko,turn,last,move" + (",result\n" if with_result else "\n")
 
-def data_str(board, ko , mv_num, last, move):
-    return ','.join([board, str(ko), str(mv_num), str(last), str(move)+'\n']) 
+def process_shard(job):
+    '''Write the positions of the SGFs in job = (root_dir, files, shard, with_result, expand)
+    to shard. The shard only appears once complete, so an interrupted run leaves no
+    partial shard behind. Returns the processed files, the shard and the number of games and positions'''
+    root_dir, files, shard, with_result, expand = job
+    games, n = 0, 0
+    with open(shard + ".tmp", 'w') as f:
+        f.write(header(with_result))
+        for path, _ in files:
+            for game in sgf.read(os.path.join(root_dir, path)):
+                games += 1
+                for row in positions(game, with_result, expand):
+                    f.write(row)
+                    n += 1
+    os.replace(shard + ".tmp", shard)
+    return files, shard, games, n
 
-def rot(b):
-    #rotates 90 deg clockwise
-    if b is None:
-        return
-    if isinstance(b, str):
-        A = np.array([enc[c] for c in b]).reshape((9,9))
-        B = np.rot90(A, k = 3).reshape(81).tolist()
-        return ''.join([ dec[n] for n in B])
-    elif isinstance(b, int):
-        if b == -1:
-            return -1
-        return (b*9 + 8 - b//9)%81
-    
-def refl(b):
-    if b is None:
-        return
-    if isinstance(b, str):
-        A = np.array([enc[c] for c in b]).reshape((9,9))
-        B = (A.T).reshape(81).tolist()
-        return ''.join([dec[n] for n in B])
-    elif isinstance(b, int):
-        if b == -1:
-            return -1
-        x, y = divmod(b, 9)
-        b = 9*y + x
-        return b
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_manifest(target_dir, with_result, expand):
+    path = os.path.join(target_dir, MANIFEST)
+    if not os.path.exists(path):
+        #files: path -> {"sha1": content hash, "shard": shard file name}
+        return {"with_result": with_result, "expand": expand, "runs": 0, "files": {}}
+    with open(path) as f:
+        manifest = json.load(f)
+    if (manifest["with_result"], manifest["expand"]) != (with_result, expand):
+        raise ValueError(f"{target_dir} was processed with -r {manifest['with_result']}, --expand {manifest['expand']}; "
+                         "use the same options or another output directory")
+    return manifest
+
+def save_manifest(target_dir, manifest):
+    path = os.path.join(target_dir, MANIFEST)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent = 0)
+    os.replace(path + ".tmp", path)
 
-def get_result(sgf):
-    with open(sgf, 'r') as f:
-        match = re.findall(r"RE\[(.*)\]", f.read())
-    if match: 
-        return 'B' if 'B' in match[0] else 'W'
-    else:
-        return None 
+def pre_process(root_dir, target_dir, with_result = False, expand = False, workers = 1):
+    '''Process the SGFs under root_dir that are not in the manifest of target_dir
+    with `workers` processes. A shard holding a file that has changed or is no longer
+    under root_dir is deleted, and its other files are processed again with the new ones.
+    Returns the number of games processed and positions written'''
+    os.makedirs(target_dir, exist_ok = True)
+    manifest = load_manifest(target_dir, with_result, expand)
+    files = manifest["files"]
+    digests = {}
+    for dirpath, _, names in os.walk(root_dir):
+        for name in sorted(names):
+            if name.endswith(sgf.EXTENSIONS):
+                path = os.path.relpath(os.path.join(dirpath, name), root_dir)
+                digests[path] = file_hash(os.path.join(root_dir, path))
+    changed = [path for path, digest in digests.items() if path in files and files[path]["sha1"] != digest]
+    removed = [path for path in files if path not in digests]
+    stale = {files[path]["shard"] for path in changed + removed}
+    redo = {path for path, entry in files.items() if entry["shard"] in stale}
+    added = sum(path not in files for path in digests)
+    print(f"{added} new SGF files, {len(changed)} changed, {len(removed)} removed, {len(files) - len(redo)} already processed")
+    if stale:
+        print(f"rewriting {len(stale)} shards holding changed or removed files")
+        #forget the stale shards before deleting them, so an interrupted run reprocesses their files
+        for path in redo:
+            del files[path]
+        save_manifest(target_dir, manifest)
+        for shard in sorted(stale):
+            if os.path.exists(os.path.join(target_dir, shard)):
+                os.remove(os.path.join(target_dir, shard))
+    new = [(path, digest) for path, digest in digests.items() if path not in files]
+    if not new:
+        return 0, 0
+    #one shard per worker, with the files dealt out round robin
+    workers = max(min(workers, len(new)), 1)
+    run = manifest["runs"]
+    manifest["runs"] += 1
+    jobs = [(root_dir, new[rank::workers], os.path.join(target_dir, f"games_{run:04d}_{rank:02d}.csv"), with_result, expand)
+            for rank in range(workers)]
+    start = perf_counter()
+    total_games, total = 0, 0
+    with mp.get_context("fork").Pool(workers) as pool:
+        for done, shard, games, n in pool.imap_unordered(process_shard, jobs):
+            files.update((path, {"sha1": digest, "shard": os.path.basename(shard)}) for path, digest in done)
+            save_manifest(target_dir, manifest)
+            total_games += games
+            total += n
+    secs = perf_counter() - start
+    print(f"{total_games} games, {total} positions in {secs:.1f}s ({total_games/secs:.0f} games/s, {workers} workers)")
+    return total_games, total
 
-def get_moves(sgf):
-    with open(sgf, 'r') as f:
-        match = re.findall(r"\[([a-z]*)\]", f.read())
-    mvs = []
-    for mv in match:
-        if len(mv) == 0:
-            mvs.append(-1) 
-        elif len(mv) == 2: 
-            mvs.append(9*(ord(mv[0])-97) + ord(mv[1])-97 )
-    return mvs
+def data_str(board, ko , mv_num, last, move, result = None):
+    row = [board, str(ko), str(mv_num), str(last), str(move)]
+    if result is not None:
+        row.append(str(result))
+    return ','.join(row) + '\n' 
 
 if __name__ == "__main__":
-    pre_process(args.i[0], args.o[0])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", type = str, required = True, metavar = "INPATH", nargs = 1, help = "input directory of SGFs and SGF archives")
+    parser.add_argument("-o", type = str, metavar = "OUTPATH", required = True, nargs = 1, help = "output directory")
+    parser.add_argument("-r", action = "store_true", help = "add a result column (1 if black won, -1 if white won) for value training")
+    parser.add_argument("--expand", action = "store_true",
+                        help = "write all 8 symmetries of each position (train.py applies a random one at load time otherwise)")
+    parser.add_argument("-j", metavar = "WORKERS", type = int, default = os.cpu_count(), help = "worker processes (default one per core)")
+    args = parser.parse_args()
+    pre_process(args.i[0], args.o[0], args.r, args.expand, args.j)